@@ -0,0 +1,129 @@
+"""
+Measure how much memory the pings take per subscription.
+
+    python benchmarks/bench_memory.py --subscriptions 1000000 --output memory.json
+
+Writes a synthetic pings.json and reports the bytes per subscription held by the way pings used to be kept in memory
+(the string dictionaries the file loads into, plus a sorted list of (guild_id, channel_id, count) tuples per user for
+the remove menu) and by the integer model the bot builds from it now.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import load_bot
+
+# Snowflake sized IDs, so the strings and integers are as big as real ones
+GUILD_BASE = 1_000_000_000_000_000_000
+CHANNEL_BASE = 1_100_000_000_000_000_000
+USER_BASE = 1_200_000_000_000_000_000
+
+def synthetic_pings(subscriptions: int, channels_per_guild: int, subscribers_per_channel: int, users: int, thresholds: list, seed: int):
+    """Return pings in their JSON form, {guild_id: {channel_id: {count: [user_ids]}}}."""
+    generator = random.Random(seed)
+    user_ids = [str(USER_BASE + generator.randrange(10 ** 15)) for _ in range(users)]
+    pings = {}
+    made = 0
+    channel = 0
+    while made < subscriptions:
+        guild_id_str = str(GUILD_BASE + channel // channels_per_guild)
+        channel_id_str = str(CHANNEL_BASE + channel)
+        counts = pings.setdefault(guild_id_str, {}).setdefault(channel_id_str, {})
+        for index, user_id_str in enumerate(generator.sample(user_ids, min(subscribers_per_channel, subscriptions - made))):
+            counts.setdefault(str(thresholds[index % len(thresholds)]), []).append(user_id_str)
+            made += 1
+        channel += 1
+    return pings
+
+def measure(build):
+    """Return (bytes still held, peak bytes, seconds) for running `build`. Its result is kept alive while measuring."""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    kept = build()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return current, peak, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscriptions", type=int, default=1_000_000)
+    parser.add_argument("--channels-per-guild", type=int, default=10)
+    parser.add_argument("--subscribers", type=int, default=100, help="Subscribers per channel.")
+    parser.add_argument("--users", type=int, default=200_000, help="Distinct users the subscribers are drawn from.")
+    parser.add_argument("--thresholds", type=lambda value: [int(part) for part in value.split(",")], default=[1, 2, 3, 5])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="memory_results.json")
+    arguments = parser.parse_args()
+    output = os.path.abspath(arguments.output)
+
+    module = load_bot(tempfile.mkdtemp(prefix="voicely-memory-"), {"VOICELY_STORAGE": "json", "VOICELY_TRACE_PATH": ""})
+    with open(os.path.join("data", "pings.json"), "w") as f:
+        json.dump(synthetic_pings(arguments.subscriptions, arguments.channels_per_guild, arguments.subscribers, arguments.users, arguments.thresholds, arguments.seed), f)
+    with open(os.path.join("data", "pings.json"), "r") as f:
+        text = f.read()
+
+    # Before: the nested string dictionaries json.load returns, and the reverse index built from them
+    def build_legacy():
+        loaded = json.loads(text)
+        index = {}
+        for guild_id_str, channels in loaded.items():
+            for channel_id_str, counts in channels.items():
+                for count_str, user_ids in counts.items():
+                    for user_id_str in user_ids:
+                        index.setdefault(user_id_str, []).append((int(guild_id_str), int(channel_id_str), int(count_str)))
+        for subscriptions in index.values():
+            subscriptions.sort()
+        return loaded, index
+    json_current, json_peak, json_seconds = measure(lambda: json.loads(text))
+    legacy_current, legacy_peak, legacy_seconds = measure(build_legacy)
+    del text
+
+    # After: pings, guild_channels and user_subscriptions built from the same file
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    module.load_pings()
+    compact_seconds = time.perf_counter() - started
+    gc.collect()
+    compact_current, compact_peak = tracemalloc.get_traced_memory()
+    # How much of that is the reverse index used by the remove menu
+    index = dict(module.user_subscriptions)
+    module.user_subscriptions.clear()
+    gc.collect()
+    del index
+    gc.collect()
+    index_bytes = compact_current - tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    subscriptions = sum(len(user_ids) for channel in module.pings.values() for user_ids in channel.subscribers.values())
+
+    report = {
+        "config": {key: value for key, value in vars(arguments).items() if key != "output"},
+        "results": {
+            "subscriptions": subscriptions,
+            "json_bytes_per_subscription": json_current / subscriptions,
+            "json_load_seconds": json_seconds,
+            "legacy_bytes_per_subscription": legacy_current / subscriptions,
+            "legacy_load_seconds": legacy_seconds,
+            "compact_bytes_per_subscription": compact_current / subscriptions,
+            "compact_without_user_index_bytes_per_subscription": (compact_current - index_bytes) / subscriptions,
+            "compact_load_peak_bytes_per_subscription": compact_peak / subscriptions,
+            "compact_load_seconds": compact_seconds,
+        },
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+
+if __name__ == "__main__":
+    main()
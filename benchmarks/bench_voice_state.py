@@ -0,0 +1,168 @@
+"""
+Benchmark on_voice_state_update against synthetic guilds.
+
+    python benchmarks/bench_voice_state.py --guilds 50 --channels 10 --subscribers 40 --events 20000 --output bench.json
+
+Subscribers are spread over the given thresholds in every channel, and members join, leave and move between channels
+following the chosen churn pattern. Reports events/sec, p50/p99 handler latency, the REST calls issued and peak memory,
+and writes them with the configuration to a JSON file so runs can be compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import DMSink, load_bot, install_sink, drive, settle, percentile
+
+# region synthetic data
+GUILD_BASE = 1_000_000_000_000_000
+CHANNEL_BASE = 2_000_000_000_000_000
+USER_BASE = 3_000_000_000_000_000
+
+def channel_ids(guild: int, channels: int):
+    return [CHANNEL_BASE + guild * channels + channel for channel in range(channels)]
+
+def add_subscriptions(module, guilds: int, channels: int, subscribers: int, thresholds: List[int]):
+    for guild in range(guilds):
+        for channel_id in channel_ids(guild, channels):
+            for subscriber in range(subscribers):
+                threshold = thresholds[subscriber % len(thresholds)]
+                module.add_ping(GUILD_BASE + guild, channel_id, threshold, USER_BASE + subscriber)
+
+def churn_events(pattern: str, guilds: int, channels: int, members: int, thresholds: List[int], events: int, seed: int):
+    """Return (timestamp, guild_id, member_id, is_bot, before_channel_id, after_channel_id) tuples."""
+    generator = random.Random(seed)
+    # Members of each guild are separate from the subscribers, so everyone who subscribed gets pinged
+    member_base = USER_BASE + 1_000_000
+    locations: dict[tuple[int, int], int | None] = {}
+    generated = []
+    timestamp = 0.0
+
+    def event(guild: int, member: int, after: int | None, is_bot: bool = False):
+        before = locations.get((guild, member))
+        locations[(guild, member)] = after
+        generated.append((timestamp, GUILD_BASE + guild, member_base + member, is_bot, before, after))
+
+    if pattern == "random":
+        # Members wander between channels, join and leave at random
+        while len(generated) < events:
+            timestamp += generator.expovariate(50)
+            guild = generator.randrange(guilds)
+            member = generator.randrange(members)
+            if locations.get((guild, member)) is not None and generator.random() < 0.5:
+                event(guild, member, None)
+            else:
+                event(guild, member, generator.choice(channel_ids(guild, channels)), is_bot=member % 25 == 0)
+    elif pattern == "storm":
+        # Channels fill up all at once and then empty, one after another
+        while len(generated) < events:
+            guild = generator.randrange(guilds)
+            channel_id = generator.choice(channel_ids(guild, channels))
+            for member in range(members):
+                timestamp += 0.05
+                event(guild, member, channel_id)
+            for member in range(members):
+                timestamp += 0.05
+                event(guild, member, None)
+    elif pattern == "flap":
+        # One member repeatedly joins and leaves a channel that is one short of the lowest threshold
+        guild = 0
+        channel_id = channel_ids(guild, channels)[0]
+        for member in range(1, min(thresholds)):
+            event(guild, member, channel_id)
+        while len(generated) < events:
+            timestamp += 1
+            event(guild, 0, channel_id if locations.get((guild, 0)) is None else None)
+    else:
+        raise ValueError(f"Unknown churn pattern `{pattern}`")
+    return generated[:events]
+# endregion
+
+async def run(arguments: argparse.Namespace):
+    environment = {
+        "VOICELY_STORAGE": "json",
+        "VOICELY_EDIT_WINDOW_MS": str(arguments.edit_window_ms),
+        "VOICELY_DM_CONCURRENCY": str(arguments.concurrency),
+        "VOICELY_PING_COOLDOWN_MS": str(arguments.cooldown_ms),
+        "VOICELY_DIGEST_WINDOW_MS": str(arguments.digest_window_ms),
+    }
+    if not arguments.route_limits:
+        # The mock answers instantly, so Discord's per-route budgets would only measure how long the run waits for them
+        environment["VOICELY_ROUTE_BURST"] = str(10 ** 9)
+    module = load_bot(tempfile.mkdtemp(prefix="voicely-bench-"), environment)
+    sink = DMSink(arguments.rest_latency_ms / 1000)
+    install_sink(module, sink)
+
+    add_subscriptions(module, arguments.guilds, arguments.channels, arguments.subscribers, arguments.thresholds)
+    if arguments.digest:
+        module.digest_users.update(module.user_subscriptions)
+    events = churn_events(arguments.pattern, arguments.guilds, arguments.channels, arguments.members, arguments.thresholds, arguments.events, arguments.seed)
+
+    if arguments.memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    latencies = await drive(module, events)
+    handled = time.perf_counter()
+    await settle(module)
+    drained = time.perf_counter()
+    peak_memory = tracemalloc.get_traced_memory()[1] if arguments.memory else None
+    if arguments.memory:
+        tracemalloc.stop()
+
+    return {
+        "config": {key: value for key, value in vars(arguments).items() if key != "output"},
+        "results": {
+            "events": len(events),
+            # Handling the events, and then sending what was still queued once they were all handled
+            "handler_seconds": handled - started,
+            "drain_seconds": drained - handled,
+            "events_per_second": len(events) / (handled - started) if handled > started else None,
+            "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+            "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+            "latency_max_ms": max(latencies, default=0) * 1000,
+            "rest_calls": dict(sink.calls),
+            "rest_calls_total": sum(sink.calls.values()),
+            "suppressed_sends": module.metrics.counters.get("voicely_suppressed_requests_total", {}).get((("kind", "send"),), 0),
+            "suppressed_deletes": module.metrics.counters.get("voicely_suppressed_requests_total", {}).get((("kind", "delete"),), 0),
+            "peak_memory_bytes": peak_memory,
+            "pings": sum(len(subscriptions) for subscriptions in module.user_subscriptions.values()),
+            "outstanding_pings": sum(len(counts) for by_user in module.bot.notified_by_channel.values() for counts in by_user.values()),
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=5, help="Voice channels per guild.")
+    parser.add_argument("--subscribers", type=int, default=20, help="Subscribers per channel.")
+    parser.add_argument("--thresholds", type=lambda value: [int(part) for part in value.split(",")], default=[1, 2, 3, 5], help="Comma separated counts the subscribers are spread over.")
+    parser.add_argument("--members", type=int, default=30, help="Members per guild who join and leave voice channels.")
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--pattern", choices=["random", "storm", "flap"], default="random")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rest-latency-ms", type=float, default=0, help="Simulated round trip for each DM request.")
+    parser.add_argument("--edit-window-ms", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--cooldown-ms", type=int, default=0, help="How long after a ping the same subscriber's next ping for the channel reuses their message.")
+    parser.add_argument("--digest", action="store_true", help="Turn on digests for every subscriber.")
+    parser.add_argument("--digest-window-ms", type=int, default=10000)
+    parser.add_argument("--route-limits", action="store_true", help="Apply the per-route rate budgets to the mock, as Discord would.")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="Don't trace peak memory, which slows the run down.")
+    parser.add_argument("--output", default="bench_results.json")
+    arguments = parser.parse_args()
+
+    output = os.path.abspath(arguments.output)
+    report = asyncio.run(run(arguments))
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+
+if __name__ == "__main__":
+    main()
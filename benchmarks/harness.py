@@ -0,0 +1,191 @@
+"""
+Drives the real voice state handler from voicely-ping.py offline, against stand-ins for the Discord objects it reads and
+a mock DM sink that records every REST call instead of sending it.
+"""
+import asyncio
+import importlib.util
+import os
+import sys
+import time
+from typing import List
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "voicely-ping.py")
+
+# region stand-ins
+class FakeGuild:
+    __slots__ = ("id",)
+
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+class FakeVoiceChannel:
+    __slots__ = ("id", "guild")
+
+    def __init__(self, channel_id: int, guild: FakeGuild):
+        self.id = channel_id
+        self.guild = guild
+
+class FakeMember:
+    __slots__ = ("id", "guild", "bot")
+
+    def __init__(self, member_id: int, guild: FakeGuild, bot: bool = False):
+        self.id = member_id
+        self.guild = guild
+        self.bot = bot
+
+class FakeVoiceState:
+    __slots__ = ("channel",)
+
+    def __init__(self, channel: FakeVoiceChannel | None):
+        self.channel = channel
+# endregion
+
+# region mock DM sink
+class DMSink:
+    """Records every DM request the bot makes, optionally waiting `latency` seconds for each like a REST round trip."""
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.calls = {"send": 0, "edit": 0, "delete": 0, "create_dm": 0}
+        self.next_message_id = 1
+
+    async def request(self, kind: str):
+        self.calls[kind] += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+class FakeMessage:
+    __slots__ = ("id", "channel")
+
+    def __init__(self, message_id: int, channel: "FakeDMChannel"):
+        self.id = message_id
+        self.channel = channel
+
+class FakePartialMessage:
+    __slots__ = ("sink", "id")
+
+    def __init__(self, sink: DMSink, message_id: int):
+        self.sink = sink
+        self.id = message_id
+
+    async def edit(self, content: str):
+        await self.sink.request("edit")
+
+    async def delete(self):
+        await self.sink.request("delete")
+
+class FakeDMChannel:
+    __slots__ = ("sink", "id")
+
+    def __init__(self, sink: DMSink, channel_id: int):
+        self.sink = sink
+        self.id = channel_id
+
+    async def send(self, content: str):
+        await self.sink.request("send")
+        message = FakeMessage(self.sink.next_message_id, self)
+        self.sink.next_message_id += 1
+        return message
+
+    def get_partial_message(self, message_id: int):
+        return FakePartialMessage(self.sink, message_id)
+
+class FakeUser:
+    __slots__ = ("sink", "id", "dm_channel")
+
+    def __init__(self, sink: DMSink, user_id: int):
+        self.sink = sink
+        self.id = user_id
+        self.dm_channel = None
+
+    async def create_dm(self):
+        await self.sink.request("create_dm")
+        # DM channel IDs are made up from the user ID, so they are stable across lookups
+        self.dm_channel = FakeDMChannel(self.sink, self.id + 1)
+        return self.dm_channel
+# endregion
+
+def load_bot(data_directory: str, environment: dict | None = None):
+    """
+    Import voicely-ping.py as a module without running the bot. Its data files are read from and written to
+    `data_directory`, and `environment` overrides its VOICELY_* settings.
+    """
+    os.environ.update(environment or {})
+    os.makedirs(os.path.join(data_directory, "data"), exist_ok=True)
+    os.chdir(data_directory)
+    spec = importlib.util.spec_from_file_location("voicely_ping", BOT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["voicely_ping"] = module
+    spec.loader.exec_module(module)
+    return module
+
+def install_sink(module, sink: DMSink):
+    """Point the bot's user and DM channel lookups at the sink instead of Discord."""
+    users: dict[int, FakeUser] = {}
+
+    def get_user(user_id: int):
+        user = users.get(user_id)
+        if user is None:
+            user = FakeUser(sink, user_id)
+            users[user_id] = user
+        return user
+
+    module.bot.get_user = get_user
+    module.bot.get_partial_messageable = lambda channel_id, **kwargs: FakeDMChannel(sink, channel_id)
+
+async def drive(module, events: List[tuple], real_time: bool = False):
+    """
+    Feed events through the handler one at a time and return the latency of each, in seconds.
+    Each event is (timestamp, guild_id, member_id, is_bot, before_channel_id, after_channel_id). With `real_time`,
+    the gaps between timestamps are waited out, otherwise events run back to back.
+    """
+    guilds: dict[int, FakeGuild] = {}
+    channels: dict[int, FakeVoiceChannel] = {}
+
+    def get_guild(guild_id: int):
+        guild = guilds.get(guild_id)
+        if guild is None:
+            guild = FakeGuild(guild_id)
+            guilds[guild_id] = guild
+        return guild
+
+    def get_channel(channel_id: int | None, guild: FakeGuild):
+        if channel_id is None:
+            return None
+        channel = channels.get(channel_id)
+        if channel is None:
+            channel = FakeVoiceChannel(channel_id, guild)
+            channels[channel_id] = channel
+        return channel
+
+    latencies: List[float] = []
+    first_timestamp = events[0][0] if events else 0
+    started = time.monotonic()
+    for timestamp, guild_id, member_id, is_bot, before_channel_id, after_channel_id in events:
+        if real_time:
+            delay = (timestamp - first_timestamp) - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        guild = get_guild(guild_id)
+        member = FakeMember(member_id, guild, is_bot)
+        before = FakeVoiceState(get_channel(before_channel_id, guild))
+        after = FakeVoiceState(get_channel(after_channel_id, guild))
+
+        event_started = time.perf_counter()
+        await module.on_voice_state_update(member, before, after)
+        latencies.append(time.perf_counter() - event_started)
+    return latencies
+
+async def settle(module):
+    """Send the edits still waiting in the coalescer and wait for every queued DM request."""
+    await module.channel_actors.drain()
+    module.digests.flush_all()
+    module.edit_coalescer.flush_all()
+    await module.outbound.drain()
+    if module.trace_recorder is not None:
+        module.trace_recorder.flush()
+
+def percentile(values: List[float], fraction: float):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
@@ -0,0 +1,94 @@
+"""
+Replay a voice state trace recorded with VOICELY_TRACE_PATH through the handler, against a mock of Discord.
+
+    python benchmarks/replay_trace.py trace.jsonl --pings data/pings.json --speed max --output replay.json
+
+Pass the pings.json (and optionally notifications.json) the bot had when the trace was recorded, so the same
+subscribers are pinged. Reports the REST calls issued and the handler latency, so runs before and after a change
+can be compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import DMSink, load_bot, install_sink, drive, settle, percentile
+
+def read_trace(path: str):
+    events = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                timestamp, guild_id, member_id, is_bot, before_channel_id, after_channel_id = json.loads(line)
+                events.append((timestamp, guild_id, member_id, bool(is_bot), before_channel_id, after_channel_id))
+    return events
+
+async def run(arguments: argparse.Namespace):
+    data_directory = tempfile.mkdtemp(prefix="voicely-replay-")
+    os.makedirs(os.path.join(data_directory, "data"))
+    for source, name in ((arguments.pings, "pings.json"), (arguments.notifications, "notifications.json")):
+        if source:
+            shutil.copy(source, os.path.join(data_directory, "data", name))
+
+    environment = {
+        "VOICELY_STORAGE": "json",
+        "VOICELY_TRACE_PATH": "",
+        "VOICELY_EDIT_WINDOW_MS": str(arguments.edit_window_ms),
+    }
+    if not arguments.route_limits:
+        # The mock answers instantly, so Discord's per-route budgets would only measure how long the run waits for them
+        environment["VOICELY_ROUTE_BURST"] = str(10 ** 9)
+    module = load_bot(data_directory, environment)
+    sink = DMSink(arguments.rest_latency_ms / 1000)
+    install_sink(module, sink)
+    module.bot.restore_notifications(module.storage.load_notifications())
+
+    events = read_trace(arguments.trace)
+    started = time.perf_counter()
+    latencies = await drive(module, events, real_time=arguments.speed == "real")
+    handled = time.perf_counter()
+    await settle(module)
+    drained = time.perf_counter()
+
+    return {
+        "config": {key: value for key, value in vars(arguments).items() if key != "output"},
+        "results": {
+            "events": len(events),
+            "handler_seconds": handled - started,
+            "drain_seconds": drained - handled,
+            "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+            "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+            "latency_max_ms": max(latencies, default=0) * 1000,
+            "rest_calls": dict(sink.calls),
+            "rest_calls_total": sum(sink.calls.values()),
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="A trace file recorded with VOICELY_TRACE_PATH.")
+    parser.add_argument("--pings", help="The pings.json to replay against.")
+    parser.add_argument("--notifications", help="The notifications.json of pings that were outstanding when the trace started.")
+    parser.add_argument("--speed", choices=["real", "max"], default="max", help="Keep the recorded gaps between events, or run them back to back.")
+    parser.add_argument("--rest-latency-ms", type=float, default=0, help="Simulated round trip for each DM request.")
+    parser.add_argument("--edit-window-ms", type=int, default=500)
+    parser.add_argument("--route-limits", action="store_true", help="Apply the per-route rate budgets to the mock, as Discord would.")
+    parser.add_argument("--output", default="replay_results.json")
+    arguments = parser.parse_args()
+
+    for name in ("trace", "pings", "notifications", "output"):
+        if getattr(arguments, name):
+            setattr(arguments, name, os.path.abspath(getattr(arguments, name)))
+    report = asyncio.run(run(arguments))
+    with open(arguments.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,494 @@
 import json
+import os
+import asyncio
+import sqlite3
+import sys
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import discord
+from aiohttp import web
 from discord import app_commands
 from discord.ext import commands
-from typing import List
+from typing import List, Coroutine, Callable
+from collections import OrderedDict, deque
 import math
+import heapq
+import time
+from functools import partial
+from bisect import bisect_left, bisect_right, insort
 from enum import Enum
+from array import array
 import datetime
+import cProfile
 # import datetime
 
-# Load bot token from file
-with open('../token', 'r') as file:
-    bot_token = file.read().strip()
+# region config
+# Settings that can be tuned per deployment through environment variables
+def env_int(name: str, default: int):
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return int(value)
+
+def return_bool(value: str):
+    if value.strip().lower() in ['true', '1', 'yes', 'y']:
+        return True
+    elif value.strip().lower() in ['false', '0', 'no', 'n']:
+        return False
+    else:
+        raise ValueError("Invalid input for boolean conversion.")
+
+def env_bool(name: str, default: bool):
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return return_bool(value)
+
+def env_shard_ids(name: str):
+    """Parse a list of shard IDs like `0-3` or `0,2,5-7`."""
+    value = os.environ.get(name, "").strip()
+    shard_ids: List[int] = []
+    for part in value.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            shard_ids.extend(range(int(start), int(end) + 1))
+        else:
+            shard_ids.append(int(part))
+    return shard_ids
+
+# The maximum number of direct message requests (sends, edits, deletes) in flight at once
+DM_CONCURRENCY = env_int("VOICELY_DM_CONCURRENCY", 10)
+# How many direct message requests each route (a DM channel, or a user that hasn't been messaged yet) may make at once,
+# and how many per second it gets back after that
+ROUTE_BURST = env_int("VOICELY_ROUTE_BURST", 5)
+ROUTE_RATE = env_int("VOICELY_ROUTE_RATE_MS", 1000) / 1000
+# How long to collect edits to a channel's notifications before sending only the latest content, in milliseconds
+EDIT_WINDOW_MS = env_int("VOICELY_EDIT_WINDOW_MS", 500)
+# The longest changed data can wait before it is written to disk, in milliseconds
+FLUSH_INTERVAL_MS = env_int("VOICELY_FLUSH_INTERVAL_MS", 2000)
+# Where pings and server settings are kept: "json" for the files in data/, or "sqlite" for an indexed database
+STORAGE_BACKEND = os.environ.get("VOICELY_STORAGE", "json").strip().lower()
+DATABASE_PATH = os.environ.get("VOICELY_DATABASE", "data/voicely.db")
+# The total number of shards. 0 lets Discord pick.
+SHARD_COUNT = env_int("VOICELY_SHARD_COUNT", 0)
+# The shards run by this process, e.g. "0-3". Empty runs every shard.
+SHARD_IDS = env_shard_ids("VOICELY_SHARD_IDS")
+# The number of processes to split the shards between. Each one only loads the pings for its own guilds.
+CLUSTER_COUNT = env_int("VOICELY_CLUSTERS", 1)
+# How often a cluster re-reads the user settings changed by commands handled in other clusters, in milliseconds
+USER_SETTINGS_RELOAD_MS = env_int("VOICELY_USER_SETTINGS_RELOAD_MS", 10000)
+# Only keep what the bot needs: no message content or member intents, no chunking at startup, and only members in voice channels cached
+LEAN_MODE = env_bool("VOICELY_LEAN", False)
+# How many users that aren't in the member cache are kept after being fetched
+USER_CACHE_SIZE = env_int("VOICELY_USER_CACHE_SIZE", 1000)
+# How many subscribers' DM channel IDs are remembered, so pings can be sent without looking the channel up first
+DM_CHANNEL_CACHE_SIZE = env_int("VOICELY_DM_CHANNEL_CACHE_SIZE", 10000)
+# Serve Prometheus metrics on this port. 0 turns the metrics endpoint off.
+METRICS_PORT = env_int("VOICELY_METRICS_PORT", 0)
+METRICS_HOST = os.environ.get("VOICELY_METRICS_HOST", "127.0.0.1")
+# Append every voice state update to this file, so it can be replayed offline with benchmarks/replay_trace.py. Empty turns recording off.
+TRACE_PATH = os.environ.get("VOICELY_TRACE_PATH", "")
+# Log every voice event, command or storage flush that takes longer than this, with the time spent in each phase. 0 turns it off.
+SLOW_EVENT_MS = env_int("VOICELY_SLOW_EVENT_MS", 0)
+# Profile one in this many events with cProfile and dump the stats to PROFILE_DIRECTORY. 0 turns it off.
+PROFILE_EVERY = env_int("VOICELY_PROFILE_EVERY", 0)
+PROFILE_DIRECTORY = os.environ.get("VOICELY_PROFILE_DIRECTORY", "profiles")
+# How many pings the background sweep for deleted channels, departed servers and members checks per tick, and how
+# long it waits between ticks. A batch of 0 turns the sweep off.
+SWEEP_BATCH = env_int("VOICELY_SWEEP_BATCH", 1000)
+SWEEP_INTERVAL_MS = env_int("VOICELY_SWEEP_INTERVAL_MS", 1000)
+# How long the sweep waits after checking everything before it starts again
+SWEEP_PASS_INTERVAL_MS = env_int("VOICELY_SWEEP_PASS_INTERVAL_MS", 600000)
+# Within this long of a subscriber's last ping for a channel, a new ping for it edits the message they already have
+# instead of deleting it and sending another, so people flapping in and out of a channel don't cause a DM each time.
+# 0 turns it off.
+PING_COOLDOWN_MS = env_int("VOICELY_PING_COOLDOWN_MS", 0)
+# How long pings for users who turned on digests are collected before they're sent together in one message
+DIGEST_WINDOW_MS = env_int("VOICELY_DIGEST_WINDOW_MS", 10000)
+# endregion
+
+# region clusters
+def owns_guild(guild_id: int):
+    """Whether this guild is on one of the shards run by this process."""
+    if len(SHARD_IDS) == 0:
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+if len(SHARD_IDS) > 0 and SHARD_COUNT == 0:
+    raise ValueError("VOICELY_SHARD_IDS needs VOICELY_SHARD_COUNT, so each process can tell which servers are on its shards.")
+if any(shard_id >= SHARD_COUNT for shard_id in SHARD_IDS):
+    raise ValueError(f"VOICELY_SHARD_IDS must be below VOICELY_SHARD_COUNT ({SHARD_COUNT}).")
+
+def launch_clusters():
+    """Run one copy of the bot per cluster, each with its own contiguous range of shards, and wait for them to exit."""
+    if SHARD_COUNT < CLUSTER_COUNT:
+        raise ValueError("VOICELY_SHARD_COUNT must be set to at least VOICELY_CLUSTERS to run clusters.")
+    if STORAGE_BACKEND != "sqlite":
+        raise ValueError("Clusters share their data through SQLite. Set VOICELY_STORAGE=sqlite to run clusters.")
+
+    processes: List[subprocess.Popen] = []
+    for cluster in range(CLUSTER_COUNT):
+        first = cluster * SHARD_COUNT // CLUSTER_COUNT
+        last = (cluster + 1) * SHARD_COUNT // CLUSTER_COUNT - 1
+        env = dict(os.environ, VOICELY_SHARD_IDS=f"{first}-{last}", VOICELY_CLUSTERS="1")
+        print(f"Starting cluster {cluster} with shards {first} to {last}")
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+if CLUSTER_COUNT > 1 and len(SHARD_IDS) == 0 and __name__ == "__main__":
+    launch_clusters()
+    sys.exit()
+# endregion
+
+# region metrics
+class Histogram:
+    __slots__ = ("bucket_counts", "sum", "count")
+
+    # Upper bounds, in seconds
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets): #Anything slower than the last bucket is only counted in +Inf
+            self.bucket_counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Counters, histograms and gauges for the voice event pipeline, rendered in the Prometheus text format."""
+    def __init__(self):
+        self.descriptions: dict[str, tuple[str, str]] = {} # {name: (type, help)}
+        self.counters: dict[str, dict[tuple, float]] = {} # {name: {labels: value}}
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.readers: dict[str, Callable[[], float]] = {} # Gauges, and counters kept by other objects, read when rendering
+
+    def describe(self, name: str, metric_type: str, help: str):
+        self.descriptions[name] = (metric_type, help)
+
+    def increment(self, name: str, labels: tuple = (), amount: float = 1):
+        counter = self.counters.setdefault(name, {})
+        counter[labels] = counter.get(labels, 0) + amount
+
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        histogram = self.histograms.setdefault(name, {}).get(labels)
+        if histogram is None:
+            histogram = Histogram()
+            self.histograms[name][labels] = histogram
+        histogram.observe(value)
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]):
+        self.describe(name, "gauge", help)
+        self.readers[name] = read
+
+    def counter(self, name: str, help: str, read: Callable[[], float]):
+        """A counter whose total is kept by something else, e.g. a cache's hit count."""
+        self.describe(name, "counter", help)
+        self.readers[name] = read
+
+    def render(self):
+        def format_labels(labels: tuple, extra: str = ""):
+            parts = [f'{key}="{value}"' for key, value in labels]
+            if extra:
+                parts.append(extra)
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        lines: List[str] = []
+        for name, (metric_type, help) in self.descriptions.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if name in self.readers:
+                lines.append(f"{name} {self.readers[name]()}")
+            elif metric_type == "counter":
+                for labels, value in self.counters.get(name, {}).items():
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            elif metric_type == "histogram":
+                for labels, histogram in self.histograms.get(name, {}).items():
+                    cumulative = 0
+                    for bound, bucket_count in zip(Histogram.buckets, histogram.bucket_counts):
+                        cumulative += bucket_count
+                        bucket_labels = format_labels(labels, f'le="{bound}"')
+                        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                    bucket_labels = format_labels(labels, 'le="+Inf"')
+                    lines.append(f"{name}_bucket{bucket_labels} {histogram.count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("voicely_voice_state_update_seconds", "histogram", "Time taken to handle a voice state update.")
+metrics.describe("voicely_voice_state_updates_total", "counter", "Voice state updates handled, by guild.")
+metrics.describe("voicely_dm_requests_total", "counter", "Direct message requests, by kind (send, edit, delete) and result (ok, failed).")
+metrics.describe("voicely_storage_flush_seconds", "histogram", "Time taken to write changed data to storage, by store.")
+metrics.describe("voicely_stale_pings_removed_total", "counter", "Pings removed because their channel, server or member is gone, by reason.")
+metrics.describe("voicely_suppressed_requests_total", "counter", "Direct message sends and deletes skipped because the subscriber was pinged for the channel within the cooldown, by kind.")
+metrics.describe("voicely_silenced_pings_total", "counter", "Pings held back because the subscriber was in their silent hours.")
+metrics.gauge("voicely_silenced_users", "Users who are in their silent hours right now.", lambda: len(silent_hours.muted))
+metrics.gauge("voicely_outbound_queue_depth", "Direct message requests waiting to run, including those waiting for their route's budget to refill.", lambda: len(outbound.queue) + outbound.deferred)
+metrics.gauge("voicely_busy_channels", "Voice channels with changes queued or running.", lambda: len(channel_actors.queues))
+metrics.gauge("voicely_pings", "Pings set up across every server.", lambda: ping_total)
+metrics.gauge("voicely_notified_pings", "Pings that have been sent and are still being kept up to date.", lambda: sum(len(counts) for by_user in bot.notified_by_channel.values() for counts in by_user.values()))
+metrics.counter("voicely_dm_channel_cache_hits_total", "Pings sent to an already known DM channel.", lambda: bot.dm_channels.hits)
+metrics.counter("voicely_dm_channel_cache_misses_total", "Pings that had to look up the DM channel first.", lambda: bot.dm_channels.misses)
+
+async def start_metrics_server():
+    """Serve the metrics on http://METRICS_HOST:METRICS_PORT/metrics."""
+    async def serve_metrics(request: web.Request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", serve_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+# endregion
+
+# region voice state traces
+class TraceRecorder:
+    """
+    Appends voice state updates to a line-delimited JSON file, one compact array per event:
+    [monotonic_timestamp, guild_id, member_id, is_bot, before_channel_id, after_channel_id]
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def record(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        entry = [
+            round(time.monotonic(), 4),
+            member.guild.id,
+            member.id,
+            int(member.bot),
+            before.channel.id if before.channel is not None else None,
+            after.channel.id if after.channel is not None else None
+        ]
+        # Buffered, so recording doesn't wait on the disk for every event. The buffer is flushed with the storage.
+        self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+trace_recorder = TraceRecorder(TRACE_PATH) if TRACE_PATH else None
+# endregion
+
+# region slow events
+class EventProfile:
+    """The time one event spent in each of its phases. A phase that is entered more than once is added up."""
+    __slots__ = ("name", "started", "last", "phases", "profiler")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.phases: dict[str, float] = {}
+        self.profiler: cProfile.Profile | None = None
+
+    def phase(self, phase: str):
+        """Mark the end of `phase`. Everything since the previous mark is counted towards it."""
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    def child(self):
+        """Return a profile for part of the event that runs alongside other parts, so their marks don't interleave."""
+        return EventProfile(self.name)
+
+    def merge(self, child: "EventProfile", prefix: str):
+        for phase, seconds in child.phases.items():
+            name = f"{prefix} {phase}"
+            self.phases[name] = self.phases.get(name, 0) + seconds
+        self.last = time.perf_counter()
+
+class QuietProfile:
+    """Stands in for an EventProfile when the instrumentation is off, so the hot path only pays for a no-op call."""
+    __slots__ = ()
+
+    def phase(self, phase: str):
+        pass
+
+    def child(self):
+        return self
+
+    def merge(self, child: "QuietProfile", prefix: str):
+        pass
+
+QUIET_PROFILE = QuietProfile()
+profiled_events = 0
+# Only one cProfile profiler can run at a time, so samples that overlap another one are skipped
+active_profiler: cProfile.Profile | None = None
+
+def start_profile(name: str):
+    global profiled_events, active_profiler
+    if not SLOW_EVENT_MS and not PROFILE_EVERY:
+        return QUIET_PROFILE
+    profile = EventProfile(name)
+    profiled_events += 1
+    if PROFILE_EVERY and profiled_events % PROFILE_EVERY == 0 and active_profiler is None:
+        # The profiler sees everything that runs on the loop until the event finishes, including other events that
+        # run while this one awaits
+        profile.profiler = cProfile.Profile()
+        active_profiler = profile.profiler
+        profile.profiler.enable()
+    return profile
+
+def save_profile(profiler: cProfile.Profile, path: str):
+    try:
+        os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+        profiler.dump_stats(path)
+    except OSError as error:
+        print(f"Cannot save profile {path}: {error}")
+
+def finish_profile(profile: EventProfile | QuietProfile, details: str = ""):
+    global active_profiler
+    if profile is QUIET_PROFILE:
+        return
+    total = time.perf_counter() - profile.started
+    if profile.profiler is not None:
+        profile.profiler.disable()
+        active_profiler = None
+        path = os.path.join(PROFILE_DIRECTORY, f"{profile.name}-{int(time.time() * 1000)}-{profiled_events}.prof")
+        # Written on a worker thread, so the event that was sampled isn't slowed down by it
+        asyncio.get_running_loop().run_in_executor(None, save_profile, profile.profiler, path)
+    if SLOW_EVENT_MS and total * 1000 >= SLOW_EVENT_MS:
+        breakdown = ", ".join(f"{phase} {seconds * 1000:.1f} ms" for phase, seconds in profile.phases.items())
+        if details:
+            details = f" ({details})"
+        print(f"Slow {profile.name} took {total * 1000:.1f} ms{details}: {breakdown or 'no phases'}")
+# endregion
 
 # Define intents
 intents = discord.Intents.default()
-intents.message_content = True
 intents.voice_states = True
-intents.members = True
+if LEAN_MODE:
+    # Voice states still bring in the members of occupied voice channels, which is all the pings need
+    intents.message_content = False
+    intents.members = False
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
+else:
+    intents.message_content = True
+    intents.members = True
+    member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+
+class LRUCache:
+    """A dictionary that forgets its least recently used entries once it holds more than `size`."""
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        return self.entries.pop(key, None)
+
+    def peek(self, key):
+        """Look a key up without counting it as a hit or miss, or marking it as recently used."""
+        return self.entries.get(key)
+
+    def __len__(self):
+        return len(self.entries)
+
+# A ping that has been sent, stored as just the IDs needed to edit or delete it later.
+# Keeping whole discord.Message objects around for every outstanding ping was the bot's biggest memory cost.
+class NotificationRecord:
+    __slots__ = ("channel_id", "message_id")
+
+    def __init__(self, channel_id: int, message_id: int):
+        self.channel_id = channel_id # The ID of the DM channel the ping was sent in
+        self.message_id = message_id
+
+    def partial_message(self):
+        return bot.get_partial_messageable(self.channel_id, type=discord.ChannelType.private).get_partial_message(self.message_id)
+
+    def update(self, voice_channel_id: int, content: str):
+        """Take the latest content for a voice channel. The message is only ever about one channel, so nothing is kept."""
+
+    def text(self, content: str):
+        """Return what the message should say after an edit with `content`."""
+        return content
+
+    def release(self, voice_channel_id: int):
+        """Stop showing a voice channel, and return whether the message should be deleted."""
+        return True
+
+    def saved(self):
+        """Return the record in the form it is saved in."""
+        return [self.channel_id, self.message_id]
+
+class DigestRecord(NotificationRecord):
+    """A message that pings about several voice channels at once, with a section for each that is edited separately."""
+    __slots__ = ("sections",)
+
+    def __init__(self, channel_id: int, message_id: int, sections: dict[int, str]):
+        super().__init__(channel_id, message_id)
+        self.sections = sections # {voice_channel_id: content}
+
+    def update(self, voice_channel_id: int, content: str):
+        self.sections[voice_channel_id] = content
+
+    def text(self, content: str):
+        return "\n\n".join(self.sections.values())
+
+    def release(self, voice_channel_id: int):
+        self.sections.pop(voice_channel_id, None)
+        return len(self.sections) == 0
+
+    def saved(self):
+        # The sections are saved too, as channels that have ended are still shown but no longer saved on their own
+        return [self.channel_id, self.message_id, {str(voice_channel_id): content for voice_channel_id, content in self.sections.items()}]
 
 # Set up the bot
-class Bot(commands.Bot):
+class Bot(commands.AutoShardedBot):
     def __init__(self):
-        super().__init__(command_prefix="$", intents=intents)
+        super().__init__(
+            # Without the message content intent, prefix commands only work in DMs or by mentioning the bot
+            command_prefix=commands.when_mentioned_or("$") if LEAN_MODE else "$",
+            intents=intents,
+            member_cache_flags=member_cache_flags,
+            chunk_guilds_at_startup=not LEAN_MODE,
+            shard_count=SHARD_COUNT or None,
+            shard_ids=SHARD_IDS or None
+        )
         self.default_settings = {
             "notify_count": 3,
             "reset_count": 0,
@@ -30,111 +497,1017 @@ class Bot(commands.Bot):
         self.notified_channels = {}
         # This dictionary will look like this:
         # {
-        #     "user_id_1": {
-        #         "channel_id_1": [notify_count_1, notify_count_2],
-        #         "channel_id_2": [notify_count_1, notify_count_2]
+        #     user_id_1: {
+        #         channel_id_1: {notify_count_1: record, notify_count_2: record},
+        #         channel_id_2: {notify_count_1: record, notify_count_2: record}
         #     },
-        #     "user_id_2": {
-        #         "channel_id_1": [notify_count_1, notify_count_2],
-        #         "channel_id_2": [notify_count_1, notify_count_2]
+        #     user_id_2: {
+        #         channel_id_1: {notify_count_1: record, notify_count_2: record},
+        #         channel_id_2: {notify_count_1: record, notify_count_2: record}
         #     }
         # }
         # make sure to not notify people if they are already in the channel
+        self.notified_by_channel = {}
+        # The same notifications, indexed by channel so voice events only touch that channel's subscribers:
+        # {
+        #     channel_id_1: {
+        #         user_id_1: {notify_count_1: record, notify_count_2: record},
+        #         user_id_2: {notify_count_1: record}
+        #     }
+        # }
+        # The inner {count: record} dictionaries are shared with notified_channels, so both views always agree.
+        self.channel_contents = {}
+        # The latest "... currently in" content rendered for each channel, {channel_id: content}
+        self.voice_counted = False
+        # Whether voice_members has been counted since the bot started. Until then, how many people were in each
+        # channel before is unknown, so the first count doesn't ping anyone.
+        self.notification_guilds = {}
+        # The guild each notified channel belongs to, {channel_id: guild_id}
+        self.fetched_users = LRUCache(USER_CACHE_SIZE)
+        # Users that weren't in the member cache when they needed to be pinged, {user_id: user}
+        self.dm_channels = LRUCache(DM_CHANNEL_CACHE_SIZE)
+        # The DM channel of each recently pinged user, {user_id: dm_channel_id}
+        self.voice_members = {}
+        # The people (not counting bots) in each occupied voice channel, kept up to date from voice state updates.
+        # Dictionaries are used as ordered sets, so members are listed in the order they joined:
+        # {channel_id: {member_id_1: None, member_id_2: None}}
+
+    async def resolve_user(self, user_id: int):
+        """Return the user from the cache, or fetch them if they aren't cached. Fetched users are kept in a bounded LRU."""
+        user = self.get_user(user_id)
+        if user is not None:
+            return user
+        user = self.fetched_users.get(user_id)
+        if user is None:
+            user = await self.fetch_user(user_id)
+            self.fetched_users.put(user_id, user)
+        return user
+
+    async def send_dm(self, user_id: int, content: str):
+        """Send a DM, going straight to the user's DM channel if it is already known."""
+        dm_channel_id = self.dm_channels.get(user_id)
+        if dm_channel_id is not None:
+            channel = self.get_partial_messageable(dm_channel_id, type=discord.ChannelType.private)
+        else:
+            user = await self.resolve_user(user_id)
+            channel = user.dm_channel or await user.create_dm()
+            self.dm_channels.put(user_id, channel.id)
+
+        try:
+            return await channel.send(content)
+        except (discord.Forbidden, discord.NotFound):
+            # The channel can't be used anymore (e.g. the user blocked the bot), so look it up again next time
+            self.dm_channels.pop(user_id)
+            raise
+
+    def count_voice_members(self, guild: discord.Guild):
+        """Count the people in every voice channel in this guild from the member cache, as {channel_id: {member_id: None}}."""
+        return {channel.id: {voice_member.id: None for voice_member in channel.members if not voice_member.bot} for channel in guild.voice_channels + guild.stage_channels}
 
     async def setup_hook(self):
+        # Pick up the pings that were still outstanding when the bot last stopped. They're reconciled in on_ready.
+        self.restore_notifications(storage.load_notifications())
+        self.flush_task = asyncio.create_task(flush_storage_periodically())
+        if SWEEP_BATCH > 0:
+            self.sweep_task = asyncio.create_task(sweep_stale_pings())
+        self.silent_hours_task = asyncio.create_task(silent_hours.run())
+        if len(SHARD_IDS) > 0 and USER_SETTINGS_RELOAD_MS > 0: #Other clusters share the database and can change user settings
+            self.user_settings_task = asyncio.create_task(reload_user_settings_periodically())
+        if METRICS_PORT:
+            self.metrics_runner = await start_metrics_server()
         print(f"Setup complete for {self.user}")
 
+    async def close(self):
+        # Finish the voice state changes that are still queued, then send any edits that are still waiting for their
+        # window to pass, and everything else that is queued
+        await channel_actors.drain()
+        digests.flush_all()
+        edit_coalescer.flush_all()
+        await outbound.drain()
+        # Write anything that hasn't been saved yet
+        if hasattr(self, "flush_task"):
+            self.flush_task.cancel()
+        if hasattr(self, "sweep_task"):
+            self.sweep_task.cancel()
+        if hasattr(self, "silent_hours_task"):
+            self.silent_hours_task.cancel()
+        if hasattr(self, "user_settings_task"):
+            self.user_settings_task.cancel()
+        await storage.close()
+        if hasattr(self, "metrics_runner"):
+            await self.metrics_runner.cleanup()
+        if trace_recorder is not None:
+            trace_recorder.close()
+        await super().close()
+
+    # region notified channels
+    def get_notifications(self, user_id: int, channel_id: int):
+        """Return the {count: record} dictionary for this user and channel, or None if they haven't been notified."""
+        return self.notified_channels.get(user_id, {}).get(channel_id)
+
+    def ensure_notifications(self, user_id: int, channel_id: int, guild_id: int):
+        """Return the {count: record} dictionary for this user and channel, creating it in both indexes if needed."""
+        user_channels = self.notified_channels.setdefault(user_id, {})
+        counts = user_channels.get(channel_id)
+        if counts is None:
+            counts = {}
+            user_channels[channel_id] = counts
+            self.notified_by_channel.setdefault(channel_id, {})[user_id] = counts
+            self.notification_guilds[channel_id] = guild_id
+            storage.notifications_changed(channel_id)
+        return counts
+
+    def pop_channel_notifications(self, channel_id: int):
+        """Remove every notification for this channel from both indexes and return them as {user_id: {count: record}}."""
+        by_user = self.notified_by_channel.pop(channel_id, {})
+        self.notification_guilds.pop(channel_id, None)
+        storage.notifications_changed(channel_id)
+        for user_id in by_user:
+            user_channels = self.notified_channels.get(user_id)
+            if user_channels is None:
+                continue
+            user_channels.pop(channel_id, None)
+            if len(user_channels) == 0:
+                del self.notified_channels[user_id]
+        return by_user
+
+    def pop_user_notifications(self, user_id: int, channel_id: int):
+        """Remove this user's notifications for a channel from both indexes and return them as {count: record}."""
+        user_channels = self.notified_channels.get(user_id)
+        if user_channels is None or channel_id not in user_channels:
+            return {}
+        counts = user_channels.pop(channel_id)
+        if len(user_channels) == 0:
+            del self.notified_channels[user_id]
+        by_user = self.notified_by_channel.get(channel_id)
+        if by_user is not None:
+            by_user.pop(user_id, None)
+            if len(by_user) == 0:
+                del self.notified_by_channel[channel_id]
+                self.notification_guilds.pop(channel_id, None)
+        storage.notifications_changed(channel_id)
+        return counts
+
+    def snapshot_notifications(self, channel_ids: List[int] | None = None):
+        """Return the outstanding pings as IDs only, in the form they are saved in:
+        {channel_id: {"guild": guild_id, "content": content, "users": {user_id: {count: [dm_channel_id, message_id] or None}}}}
+        Digests are saved as [dm_channel_id, message_id, {voice_channel_id: content}]. With `channel_ids`, only those
+        channels that still have pings are included."""
+        if channel_ids is None:
+            channel_ids = self.notified_by_channel
+        return {
+            str(channel_id): {
+                "guild": self.notification_guilds.get(channel_id),
+                "content": self.channel_contents.get(channel_id),
+                "users": {str(user_id): {str(count): None if record is None else record.saved() for count, record in counts.items()} for user_id, counts in self.notified_by_channel[channel_id].items()}
+            }
+            for channel_id in channel_ids
+            if channel_id in self.notified_by_channel
+        }
+
+    def restore_notifications(self, saved: dict):
+        # A digest is saved under each of its channels, and they all share one record again
+        records: dict[int, NotificationRecord] = {}
+        for channel in saved.values():
+            for counts in channel["users"].values():
+                for ids in counts.values():
+                    if ids is not None and ids[1] not in records:
+                        if len(ids) > 2:
+                            records[ids[1]] = DigestRecord(ids[0], ids[1], {int(voice_channel_id_str): content for voice_channel_id_str, content in ids[2].items()})
+                        else:
+                            records[ids[1]] = NotificationRecord(ids[0], ids[1])
+
+        for channel_id_str, channel in saved.items():
+            channel_id = int(channel_id_str)
+            for user_id_str, counts in channel["users"].items():
+                restored = self.ensure_notifications(int(user_id_str), channel_id, channel["guild"])
+                for count_str, ids in counts.items():
+                    if ids is None:
+                        restored[int(count_str)] = None
+                        continue
+                    restored[int(count_str)] = records[ids[1]]
+                    self.dm_channels.put(int(user_id_str), ids[0])
+            if channel["content"] is not None:
+                self.channel_contents[channel_id] = channel["content"]
+    # endregion
+
 
 # Create the bot instance with a command prefix
 bot = Bot()
 
 # region save and load settings
 
+# region write-behind storage
+class JsonStore:
+    """A JSON file that is only written once it has been marked dirty, in the background and atomically."""
+    def __init__(self, path: str, snapshot: Callable[[], object]):
+        self.path = path
+        # Returns a copy of the data that is safe to serialize outside of the event loop
+        self.snapshot = snapshot
+        self.dirty = False
+        self.lock = asyncio.Lock()
+
+    def load(self):
+        # Load notify data from file (or return an empty dictionary if the file doesn't exist)
+        try:
+            with open(self.path, 'r') as f:
+                # Load JSON data into a dictionary
+                return json.load(f)
+        except FileNotFoundError as error:
+            print(f"Cannot load {os.path.basename(self.path)}: {error}")
+            # If the file doesn't exist, return an empty dictionary
+            return {}
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def write(self, data):
+        # Runs in a worker thread. Writing to a temporary file and renaming it means a crash can never leave a truncated file behind.
+        serialized = json.dumps(data)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(serialized)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    async def flush(self):
+        async with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            started = time.perf_counter()
+            data = self.snapshot()
+            try:
+                await asyncio.to_thread(self.write, data)
+            except OSError as error:
+                self.dirty = True
+                print(f"Cannot save {self.path}: {error}")
+            metrics.observe("voicely_storage_flush_seconds", time.perf_counter() - started, (("store", os.path.basename(self.path)),))
+
+async def flush_storage_periodically():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL_MS / 1000)
+        profile = start_profile("storage_flush")
+        await storage.flush()
+        profile.phase("persistence")
+        finish_profile(profile)
+        if trace_recorder is not None:
+            trace_recorder.flush()
+# endregion
+
+# region storage backends
+class JsonStorage:
+    """Keeps pings and server settings in JSON files, which are rewritten in the background after they change."""
+    def __init__(self):
+        # The snapshot functions are looked up when a store is flushed, because they're defined after the storage is opened
+        self.pings_store = JsonStore('data/pings.json', lambda: snapshot_pings())
+        self.settings_store = JsonStore('data/server_settings.json', lambda: snapshot_server_settings())
+        self.user_settings_store = JsonStore('data/user_settings.json', lambda: snapshot_user_settings())
+        self.notifications_store = JsonStore('data/notifications.json', bot.snapshot_notifications)
+
+    def load_pings(self):
+        """Yield every ping on this process's shards as (guild_id, channel_id, count, user_id)."""
+        for guild_id_str, channels in self.pings_store.load().items():
+            guild_id = int(guild_id_str)
+            if not owns_guild(guild_id):
+                continue
+            for channel_id_str, counts in channels.items():
+                channel_id = int(channel_id_str)
+                for count_str, user_ids in counts.items():
+                    count = int(count_str)
+                    for user_id_str in user_ids:
+                        yield guild_id, channel_id, count, int(user_id_str)
+
+    def load_server_settings(self):
+        return {guild_id_str: settings for guild_id_str, settings in self.settings_store.load().items() if owns_guild(int(guild_id_str))}
+
+    def load_user_settings(self):
+        # Users aren't tied to a shard, so every process loads all of them
+        return self.user_settings_store.load()
+
+    def load_notifications(self):
+        return {channel_id_str: channel for channel_id_str, channel in self.notifications_store.load().items() if channel["guild"] is None or owns_guild(channel["guild"])}
+
+    def add_subscription(self, guild_id: int, channel_id: int, count: int, user_id: int):
+        self.pings_store.mark_dirty()
+
+    def remove_subscription(self, guild_id: int, channel_id: int, count: int, user_id: int):
+        self.pings_store.mark_dirty()
+
+    def set_setting(self, guild_id_str: str, key: str, value: str):
+        self.settings_store.mark_dirty()
+
+    def delete_setting(self, guild_id_str: str, key: str):
+        self.settings_store.mark_dirty()
+
+    def set_user_setting(self, user_id_str: str, key: str, value: str):
+        self.user_settings_store.mark_dirty()
+
+    def delete_user_setting(self, user_id_str: str, key: str):
+        self.user_settings_store.mark_dirty()
+
+    def notifications_changed(self, channel_id: int):
+        self.notifications_store.mark_dirty()
+
+    async def flush(self):
+        await self.pings_store.flush()
+        await self.settings_store.flush()
+        await self.user_settings_store.flush()
+        await self.notifications_store.flush()
+
+    async def close(self):
+        await self.flush()
+
+class SqliteStorage:
+    """
+    Keeps pings and server settings in an indexed SQLite database, written one row at a time.
+    Every query runs on a single worker thread, so writes never block the event loop and are applied in order.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, channel_id, count, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS subscriptions_by_user ON subscriptions (user_id);
+        CREATE TABLE IF NOT EXISTS server_settings (
+            guild_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (guild_id, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (user_id, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS notified_channels (
+            channel_id INTEGER PRIMARY KEY,
+            guild_id INTEGER,
+            content TEXT
+        );
+        CREATE TABLE IF NOT EXISTS notifications (
+            channel_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            dm_channel_id INTEGER,
+            message_id INTEGER,
+            sections TEXT,
+            PRIMARY KEY (channel_id, user_id, count)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Clusters share the database, so wait for each other's writes rather than failing straight away
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(self.schema)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        # Outstanding pings change on almost every voice event, so they are written behind like the JSON files. Only the
+        # channels whose pings changed are written again.
+        self.dirty_channels: set[int] = set()
+        self.migrate_from_json()
+
+    # region migration
+    def migrate_from_json(self):
+        """Copy the JSON files in data/ into the database, each the first time it is opened by a version that keeps that data in it."""
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self.migrate_settings_and_pings()
+        if version < 2:
+            self.migrate_user_settings_and_notifications()
+        if version < 3:
+            self.add_digest_sections()
+
+    def migrate_settings_and_pings(self):
+        old_pings = JsonStore('data/pings.json', dict).load()
+        old_settings = JsonStore('data/server_settings.json', dict).load()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO subscriptions (guild_id, channel_id, count, user_id) VALUES (?, ?, ?, ?)",
+                ((int(guild_id_str), int(channel_id_str), int(count_str), int(user_id_str))
+                 for guild_id_str, channels in old_pings.items()
+                 for channel_id_str, counts in channels.items()
+                 for count_str, user_ids in counts.items()
+                 for user_id_str in user_ids)
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO server_settings (guild_id, key, value) VALUES (?, ?, ?)",
+                ((int(guild_id_str), key, value)
+                 for guild_id_str, settings in old_settings.items()
+                 for key, value in settings.items())
+            )
+            self.connection.execute("PRAGMA user_version = 1")
+        print(f"Migrated pings.json and server_settings.json into {self.path}")
+
+    def migrate_user_settings_and_notifications(self):
+        old_user_settings = JsonStore('data/user_settings.json', dict).load()
+        old_notifications = JsonStore('data/notifications.json', dict).load()
+        with self.connection:
+            # Rows already in the database were written after the JSON files, so they're kept
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO user_settings (user_id, key, value) VALUES (?, ?, ?)",
+                ((int(user_id_str), key, value)
+                 for user_id_str, settings in old_user_settings.items()
+                 for key, value in settings.items())
+            )
+            saved_channels = {channel_id for (channel_id,) in self.connection.execute("SELECT channel_id FROM notified_channels")}
+            self.insert_notifications({channel_id_str: channel for channel_id_str, channel in old_notifications.items() if int(channel_id_str) not in saved_channels})
+            self.connection.execute("PRAGMA user_version = 2")
+        print(f"Migrated user_settings.json and notifications.json into {self.path}")
+
+    def add_digest_sections(self):
+        with self.connection:
+            columns = [name for _, name, *_ in self.connection.execute("PRAGMA table_info(notifications)")]
+            if "sections" not in columns: #Created before digests were saved
+                self.connection.execute("ALTER TABLE notifications ADD COLUMN sections TEXT")
+            self.connection.execute("PRAGMA user_version = 3")
+    # endregion
+
+    # region loading
+    def owned_guilds(self):
+        """Return a WHERE condition and its parameters that match the guilds on this process's shards."""
+        if len(SHARD_IDS) == 0:
+            return "1", ()
+        return f"((guild_id >> 22) % ?) IN ({', '.join('?' * len(SHARD_IDS))})", (SHARD_COUNT, *SHARD_IDS)
+
+    def load_pings(self):
+        """Return every ping on this process's shards as (guild_id, channel_id, count, user_id) rows."""
+        condition, parameters = self.owned_guilds()
+        return self.connection.execute(f"SELECT guild_id, channel_id, count, user_id FROM subscriptions WHERE {condition}", parameters)
+
+    def load_server_settings(self):
+        loaded = {}
+        condition, parameters = self.owned_guilds()
+        for guild_id, key, value in self.connection.execute(f"SELECT guild_id, key, value FROM server_settings WHERE {condition}", parameters):
+            loaded.setdefault(str(guild_id), {})[key] = value
+        return loaded
+
+    def load_user_settings(self):
+        loaded = {}
+        for user_id, key, value in self.connection.execute("SELECT user_id, key, value FROM user_settings"):
+            loaded.setdefault(str(user_id), {})[key] = value
+        return loaded
+
+    async def reload_user_settings(self):
+        # On the worker thread, so it sees this process's own queued writes
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.load_user_settings)
+
+    def load_notifications(self):
+        loaded = {}
+        condition, parameters = self.owned_guilds()
+        for channel_id, guild_id, content in self.connection.execute(f"SELECT channel_id, guild_id, content FROM notified_channels WHERE {condition}", parameters):
+            loaded[str(channel_id)] = {"guild": guild_id, "content": content, "users": {}}
+        for channel_id, user_id, count, dm_channel_id, message_id, sections in self.connection.execute(f"SELECT channel_id, user_id, count, dm_channel_id, message_id, sections FROM notifications WHERE channel_id IN (SELECT channel_id FROM notified_channels WHERE {condition})", parameters):
+            ids = None if message_id is None else [dm_channel_id, message_id]
+            if ids is not None and sections is not None:
+                ids.append(json.loads(sections))
+            loaded[str(channel_id)]["users"].setdefault(str(user_id), {})[str(count)] = ids
+        return loaded
+    # endregion
+
+    # region point lookups
+    def run_query(self, query: str, parameters: tuple):
+        return self.connection.execute(query, parameters).fetchall()
+
+    async def query(self, query: str, parameters: tuple):
+        # On the worker thread, so it sees this process's own queued writes
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.run_query, query, parameters)
+
+    async def subscribers(self, guild_id: int, channel_id: int, count: int):
+        """Return the IDs of the users pinged when `count` people are in this channel."""
+        rows = await self.query("SELECT user_id FROM subscriptions WHERE guild_id = ? AND channel_id = ? AND count = ?", (guild_id, channel_id, count))
+        return [user_id for (user_id,) in rows]
+
+    async def subscriptions_for_user(self, user_id: int):
+        """Return every (guild_id, channel_id, count) this user will be pinged for, in every cluster's guilds."""
+        return await self.query("SELECT guild_id, channel_id, count FROM subscriptions WHERE user_id = ?", (user_id,))
+    # endregion
+
+    # region writes
+    def run_write(self, query: str, parameters: tuple):
+        with self.connection:
+            self.connection.execute(query, parameters)
+
+    def report_error(self, future):
+        error = future.exception()
+        if error is not None:
+            print(f"Cannot save to {self.path}: {error}")
+
+    def write(self, query: str, parameters: tuple):
+        # Queued on the worker thread without waiting for it, so the caller doesn't need to be async
+        self.executor.submit(self.run_write, query, parameters).add_done_callback(self.report_error)
+
+    def add_subscription(self, guild_id: int, channel_id: int, count: int, user_id: int):
+        self.write("INSERT OR IGNORE INTO subscriptions (guild_id, channel_id, count, user_id) VALUES (?, ?, ?, ?)", (guild_id, channel_id, count, user_id))
+
+    def remove_subscription(self, guild_id: int, channel_id: int, count: int, user_id: int):
+        self.write("DELETE FROM subscriptions WHERE guild_id = ? AND channel_id = ? AND count = ? AND user_id = ?", (guild_id, channel_id, count, user_id))
+
+    def set_setting(self, guild_id_str: str, key: str, value: str):
+        self.write("INSERT OR REPLACE INTO server_settings (guild_id, key, value) VALUES (?, ?, ?)", (int(guild_id_str), key, value))
+
+    def delete_setting(self, guild_id_str: str, key: str):
+        self.write("DELETE FROM server_settings WHERE guild_id = ? AND key = ?", (int(guild_id_str), key))
+
+    def set_user_setting(self, user_id_str: str, key: str, value: str):
+        self.write("INSERT OR REPLACE INTO user_settings (user_id, key, value) VALUES (?, ?, ?)", (int(user_id_str), key, value))
+
+    def delete_user_setting(self, user_id_str: str, key: str):
+        self.write("DELETE FROM user_settings WHERE user_id = ? AND key = ?", (int(user_id_str), key))
+
+    def notifications_changed(self, channel_id: int):
+        self.dirty_channels.add(channel_id)
+
+    def run_save_notifications(self, channel_ids: List[int], snapshot: dict):
+        """Replace the saved pings of these channels with `snapshot`, which leaves out the channels that no longer have any."""
+        with self.connection:
+            self.connection.executemany("DELETE FROM notifications WHERE channel_id = ?", ((channel_id,) for channel_id in channel_ids))
+            self.connection.executemany("DELETE FROM notified_channels WHERE channel_id = ?", ((channel_id,) for channel_id in channel_ids))
+            self.insert_notifications(snapshot)
+
+    def insert_notifications(self, snapshot: dict):
+        """Add outstanding pings in the form bot.snapshot_notifications returns them. Runs inside the caller's transaction."""
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO notified_channels (channel_id, guild_id, content) VALUES (?, ?, ?)",
+            ((int(channel_id_str), channel["guild"], channel["content"]) for channel_id_str, channel in snapshot.items())
+        )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO notifications (channel_id, user_id, count, dm_channel_id, message_id, sections) VALUES (?, ?, ?, ?, ?, ?)",
+            ((int(channel_id_str), int(user_id_str), int(count_str), *(ids[:2] if ids is not None else (None, None)), json.dumps(ids[2]) if ids is not None and len(ids) > 2 else None)
+             for channel_id_str, channel in snapshot.items()
+             for user_id_str, counts in channel["users"].items()
+             for count_str, ids in counts.items())
+        )
+    # endregion
+
+    async def flush(self):
+        # Pings and settings are written as they change, so only the outstanding pings need flushing
+        if len(self.dirty_channels) == 0:
+            return
+        channel_ids = list(self.dirty_channels)
+        self.dirty_channels.clear()
+        started = time.perf_counter()
+        snapshot = bot.snapshot_notifications(channel_ids)
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.run_save_notifications, channel_ids, snapshot)
+        except sqlite3.Error as error:
+            self.dirty_channels.update(channel_ids)
+            print(f"Cannot save to {self.path}: {error}")
+        metrics.observe("voicely_storage_flush_seconds", time.perf_counter() - started, (("store", "notifications"),))
+
+    async def close(self):
+        await self.flush()
+        # Wait for the queued writes to finish
+        await asyncio.to_thread(self.executor.shutdown, True)
+        self.connection.close()
+
+def open_storage():
+    if len(SHARD_IDS) > 0 and STORAGE_BACKEND != "sqlite":
+        raise ValueError("Running a subset of shards needs VOICELY_STORAGE=sqlite, so clusters don't overwrite each other's JSON files.")
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(DATABASE_PATH)
+    elif STORAGE_BACKEND == "json":
+        return JsonStorage()
+    else:
+        raise ValueError(f"Unknown storage backend `{STORAGE_BACKEND}`. Use `json` or `sqlite`.")
+
+storage = open_storage()
+# endregion
+
 # region pings
-# Store users who want to be notified in a dictionary {guild_id: set(user_ids)}
-# Load notify data from file (or return an empty dictionary if the file doesn't exist)
-def load_pings():
-    try:
-        with open('data/pings.json', 'r') as f:
-            # Load JSON data into a dictionary
-            return json.load(f)
-    except FileNotFoundError as error:
-        print(f"Cannot load pings.json: {error}")
-        # If the file doesn't exist, return an empty dictionary
-        return {}
+# Pings are kept in memory with integer IDs. They're only turned into strings when written to the JSON file, which
+# looks like {guild_id: {channel_id: {count: [user_ids]}}}.
+class ChannelPings:
+    """The pings set up for one voice channel. The users for each count are a sorted array of IDs."""
+    __slots__ = ("guild_id", "channel_id", "subscribers", "thresholds")
+
+    def __init__(self, guild_id: int, channel_id: int):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.subscribers: dict[int, array] = {}
+        # The counts with pings, sorted so the counts passed by a join can be found with a bisect
+        self.thresholds: List[int] = []
+
+    def add(self, count: int, user_id: int):
+        """Add a user to a count and return whether they weren't already there."""
+        user_ids = self.subscribers.get(count)
+        if user_ids is None:
+            user_ids = array('q')
+            self.subscribers[count] = user_ids
+            insort(self.thresholds, count)
+        position = bisect_left(user_ids, user_id)
+        if position < len(user_ids) and user_ids[position] == user_id:
+            return False
+        user_ids.insert(position, user_id)
+        return True
 
+    def remove(self, count: int, user_id: int):
+        """Remove a user from a count and return whether they were there."""
+        user_ids = self.subscribers.get(count)
+        if user_ids is None:
+            return False
+        position = bisect_left(user_ids, user_id)
+        if position == len(user_ids) or user_ids[position] != user_id:
+            return False
+        del user_ids[position]
+        if len(user_ids) == 0:
+            del self.subscribers[count]
+            self.thresholds.remove(count)
+        return True
+
+# {channel_id: ChannelPings}. Channel IDs are unique across guilds, so the guild is kept on each channel instead.
+pings: dict[int, ChannelPings] = {}
+# How many pings there are in total, kept up to date by add_ping and remove_ping so it doesn't have to be counted
+ping_total = 0
+
+# The channels with pings in each guild, {guild_id: {channel_id_1, channel_id_2}}
+guild_channels: dict[int, set[int]] = {}
 
-# Load the data from the JSON file when the bot starts
-pings = load_pings()
+class UserPings:
+    """
+    One user's pings as a sorted array of (guild_id, channel_id, count) triples, three integers per ping instead of a
+    tuple each. Indexing and slicing return tuples, so it can be searched and updated with bisect like a sorted list.
+    """
+    __slots__ = ("ids",)
+
+    def __init__(self, sorted_pings: List[tuple[int, int, int]] = ()):
+        self.ids = array('q')
+        for ping in sorted_pings:
+            self.ids.extend(ping)
+
+    def __len__(self):
+        return len(self.ids) // 3
+
+    def __getitem__(self, index: int | slice):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start = index * 3
+        return (self.ids[start], self.ids[start + 1], self.ids[start + 2])
+
+    def insert(self, index: int, ping: tuple[int, int, int]):
+        start = index * 3
+        self.ids[start:start] = array('q', ping)
+
+    def __delitem__(self, index: int):
+        start = index * 3
+        del self.ids[start:start + 3]
+
+# Reverse index of pings, so a user's pings can be found without scanning every guild. Each user's pings are kept
+# sorted, so the remove menu can page through them from a cursor without building every option:
+# {
+#     user_id_1: UserPings([(guild_id_1, channel_id_1, count_1), (guild_id_1, channel_id_2, count_1)]),
+#     user_id_2: UserPings([(guild_id_2, channel_id_1, count_2)])
+# }
+user_subscriptions: dict[int, UserPings] = {}
 
-# Save the current notify data to a JSON file
-def save_pings():
-    with open('data/pings.json', 'w') as f:
-        # Write the dictionary to the JSON file
-        json.dump(pings, f)
+def load_pings():
+    """Build pings and its indexes from the (guild_id, channel_id, count, user_id) rows in storage."""
+    global ping_total
+    pings.clear()
+    guild_channels.clear()
+    user_subscriptions.clear()
+    loaded_subscriptions: dict[int, List[tuple[int, int, int]]] = {}
+    for guild_id, channel_id, count, user_id in storage.load_pings():
+        channel = pings.get(channel_id)
+        if channel is None:
+            channel = ChannelPings(guild_id, channel_id)
+            pings[channel_id] = channel
+            guild_channels.setdefault(guild_id, set()).add(channel_id)
+        user_ids = channel.subscribers.get(count)
+        if user_ids is None:
+            user_ids = array('q')
+            channel.subscribers[count] = user_ids
+        # Appended and sorted once everything is loaded, rather than inserted in order one at a time
+        user_ids.append(user_id)
+        loaded_subscriptions.setdefault(user_id, []).append((guild_id, channel_id, count))
+
+    for channel in pings.values():
+        for count, user_ids in channel.subscribers.items():
+            channel.subscribers[count] = array('q', sorted(set(user_ids)))
+        channel.thresholds = sorted(channel.subscribers)
+    ping_total = sum(len(user_ids) for channel in pings.values() for user_ids in channel.subscribers.values())
+    for user_id, subscriptions in loaded_subscriptions.items():
+        user_subscriptions[user_id] = UserPings(sorted(set(subscriptions)))
+
+def crossed_thresholds(channel_id: int, previous_count: int, count: int):
+    """Return the counts with pings that were passed when this channel went from `previous_count` to `count` people, lowest first."""
+    channel = pings.get(channel_id)
+    if channel is None or count <= previous_count:
+        return []
+    thresholds = channel.thresholds
+    return thresholds[bisect_right(thresholds, previous_count):bisect_right(thresholds, count)]
+
+def add_ping(guild_id: int, channel_id: int, count: int, user_id: int):
+    """Add a ping to pings, the reverse index and storage."""
+    global ping_total
+    channel = pings.get(channel_id)
+    if channel is None:
+        channel = ChannelPings(guild_id, channel_id)
+        pings[channel_id] = channel
+        guild_channels.setdefault(guild_id, set()).add(channel_id)
+    if not channel.add(count, user_id):
+        return
+    ping_total += 1
+    subscriptions = user_subscriptions.get(user_id)
+    if subscriptions is None:
+        subscriptions = UserPings()
+        user_subscriptions[user_id] = subscriptions
+    insort(subscriptions, (guild_id, channel_id, count))
+    storage.add_subscription(guild_id, channel_id, count, user_id)
+
+def remove_ping(guild_id: int, channel_id: int, count: int, user_id: int):
+    """Remove a ping from pings, the reverse index and storage, pruning anything left empty."""
+    # Another cluster has this guild's pings in memory, and finds out from the database before it next pings anyone
+    if owns_guild(guild_id):
+        forget_ping(guild_id, channel_id, count, user_id)
+    storage.remove_subscription(guild_id, channel_id, count, user_id)
+
+def forget_ping(guild_id: int, channel_id: int, count: int, user_id: int):
+    """Remove a ping from pings and the reverse index, pruning anything left empty, without touching storage."""
+    global ping_total
+    channel = pings.get(channel_id)
+    if channel is not None and channel.remove(count, user_id):
+        ping_total -= 1
+    if channel is not None and len(channel.subscribers) == 0:
+        del pings[channel_id]
+        channels = guild_channels.get(channel.guild_id)
+        if channels is not None:
+            channels.discard(channel_id)
+            if len(channels) == 0:
+                del guild_channels[channel.guild_id]
+
+    subscriptions = user_subscriptions.get(user_id)
+    if subscriptions is not None:
+        key = (guild_id, channel_id, count)
+        position = bisect_left(subscriptions, key)
+        if position < len(subscriptions) and subscriptions[position] == key:
+            del subscriptions[position]
+        if len(subscriptions) == 0:
+            del user_subscriptions[user_id]
+
+async def forget_removed_pings(channel_id: int, thresholds: List[int]):
+    """
+    Drop the pings for these counts that were removed through another cluster. Clusters share the database, but
+    /ping remove can be used from any of them, so the database is checked before this cluster pings anyone.
+    """
+    channel = pings.get(channel_id)
+    if channel is None:
+        return
+    for count in thresholds:
+        stored = set(await storage.subscribers(channel.guild_id, channel_id, count))
+        for user_id in list(channel.subscribers.get(count, ())):
+            if user_id not in stored:
+                forget_ping(channel.guild_id, channel_id, count, user_id)
+
+def remove_channel_pings(channel_id: int):
+    """Remove every ping for a channel and return how many there were."""
+    channel = pings.get(channel_id)
+    if channel is None:
+        return 0
+    removed = 0
+    for count, user_ids in list(channel.subscribers.items()):
+        for user_id in list(user_ids):
+            remove_ping(channel.guild_id, channel_id, count, user_id)
+            removed += 1
+    return removed
+
+def member_channels(guild_id: int, user_id: int):
+    """Return the channels in a guild that a user has pings for."""
+    subscriptions = user_subscriptions.get(user_id, [])
+    # The user's pings are sorted by guild first, so the ones in this guild are next to each other
+    return {channel_id for _, channel_id, _ in subscriptions[bisect_left(subscriptions, (guild_id,)):bisect_left(subscriptions, (guild_id + 1,))]}
+
+def remove_member_pings(guild_id: int, channel_id: int, user_id: int):
+    """Remove every ping a user has for a channel and return how many there were."""
+    subscriptions = user_subscriptions.get(user_id, [])
+    in_channel = subscriptions[bisect_left(subscriptions, (guild_id, channel_id)):bisect_left(subscriptions, (guild_id, channel_id + 1))]
+    for _, _, count in in_channel:
+        remove_ping(guild_id, channel_id, count, user_id)
+    return len(in_channel)
+
+# Load the data when the bot starts
+load_pings()
+
+def snapshot_pings():
+    snapshot = {}
+    for channel_id, channel in pings.items():
+        snapshot.setdefault(str(channel.guild_id), {})[str(channel_id)] = {str(count): [str(user_id) for user_id in user_ids] for count, user_ids in channel.subscribers.items()}
+    return snapshot
 
 # endregion
 
 # region server settings
-# Store users who want to be notified in a dictionary {guild_id: set(user_ids)}
-# Load notify data from file (or return an empty dictionary if the file doesn't exist)
-def load_server_settings():
-    try:
-        with open('data/server_settings.json', 'r') as f:
-            # Load JSON data into a dictionary
-            return json.load(f)
-    except FileNotFoundError as error:
-        print(f"Cannot load server_settings.json: {error}")
-        # If the file doesn't exist, return an empty dictionary
-        return {}
+# Store settings for each server in a dictionary {guild_id: {setting: value}}
+# Load the data when the bot starts
+server_settings = storage.load_server_settings()
+
+def snapshot_server_settings():
+    return {guild_id_str: dict(settings) for guild_id_str, settings in server_settings.items()}
+
+def set_server_setting(guild_id_str: str, key: str, value: str):
+    server_settings.setdefault(guild_id_str, {})[key] = value
+    storage.set_setting(guild_id_str, key, value)
+
+def delete_server_setting(guild_id_str: str, key: str):
+    settings = server_settings.get(guild_id_str)
+    if settings is None or key not in settings:
+        return
+    del settings[key]
+    if len(settings) == 0:
+        del server_settings[guild_id_str]
+    storage.delete_setting(guild_id_str, key)
+
+# endregion
+
+# region user settings
+# Store personal settings for each user in a dictionary {user_id: {setting: value}}
+user_settings = storage.load_user_settings()
 
+# The users who get their pings in digests, kept as a set so the voice event handler doesn't parse settings
+digest_users: set[int] = {int(user_id_str) for user_id_str, settings in user_settings.items() if return_bool(settings.get("digest", "false"))}
 
-# Load the data from the JSON file when the bot starts
-server_settings = load_server_settings()
+def snapshot_user_settings():
+    return {user_id_str: dict(settings) for user_id_str, settings in user_settings.items()}
 
-# Save the current notify data to a JSON file
-def save_server_settings():
-    with open('data/server_settings.json', 'w') as f:
-        # Write the dictionary to the JSON file
-        json.dump(server_settings, f)
+def set_user_setting(user_id_str: str, key: str, value: str):
+    user_settings.setdefault(user_id_str, {})[key] = value
+    storage.set_user_setting(user_id_str, key, value)
+
+def delete_user_setting(user_id_str: str, key: str):
+    settings = user_settings.get(user_id_str)
+    if settings is None or key not in settings:
+        return
+    del settings[key]
+    if len(settings) == 0:
+        del user_settings[user_id_str]
+    storage.delete_user_setting(user_id_str, key)
+
+def apply_user_settings(loaded: dict):
+    """Replace the user settings with a fresh copy from storage, and update the digest and silent hours of users whose settings changed."""
+    for user_id_str in user_settings.keys() | loaded.keys():
+        old = user_settings.get(user_id_str, {})
+        new = loaded.get(user_id_str, {})
+        if old == new:
+            continue
+        user_id = int(user_id_str)
+        if return_bool(new.get("digest", "false")):
+            digest_users.add(user_id)
+        else:
+            digest_users.discard(user_id)
+        if new.get("silent_hours") != old.get("silent_hours"):
+            apply_silent_hours(user_id, new.get("silent_hours"))
+    user_settings.clear()
+    user_settings.update(loaded)
+
+async def reload_user_settings_periodically():
+    """Pick up the settings changed through other clusters, as each cluster only changes its own copy."""
+    while True:
+        await asyncio.sleep(USER_SETTINGS_RELOAD_MS / 1000)
+        try:
+            apply_user_settings(await storage.reload_user_settings())
+        except sqlite3.Error as error:
+            print(f"Cannot reload user settings: {error}")
 
 # endregion
 
 # region silent hours
+MINUTES_PER_DAY = 24 * 60
 
-# def load_times():
-#     try:
-#         with open('data/silent_hours.json', 'r') as f:
-#             # Load JSON data into a dictionary
-#             return json.load(f)
-#     except FileNotFoundError as error:
-#         print(f"Cannot load silent_hours.json: {error}")
-#         # If the file doesn't exist, return an empty dictionary
-#         return {}
+def current_minute():
+    """Minutes since the epoch, in UTC."""
+    return int(time.time() // 60)
 
+def in_silent_hours(start: int, end: int, minute_of_day: int):
+    if start < end:
+        return start <= minute_of_day < end
+    return minute_of_day >= start or minute_of_day < end #The window goes past midnight
 
-# # Load the data from the JSON file when the bot starts
-# silent_hours = load_times()
+class SilentHours:
+    """
+    Keeps the set of users who are in their silent hours right now, so the voice event handler only has to look them up.
+    Windows are kept in UTC on a wheel with a slot for every minute of the day. Once a minute the wheel turns, and the users
+    whose windows start or end at that minute are moved into or out of the set.
+    Pings held back while a user was muted are sent together once their window ends.
+    """
+    def __init__(self):
+        self.starts: List[set[int]] = [set() for _ in range(MINUTES_PER_DAY)]
+        self.ends: List[set[int]] = [set() for _ in range(MINUTES_PER_DAY)]
+        self.windows: dict[int, tuple[int, int]] = {}
+        self.muted: set[int] = set()
+        # {user_id: {channel_id: highest count passed}} for the pings held back in each user's current window
+        self.held: dict[int, dict[int, int]] = {}
+        self.cursor = current_minute()
+
+    def set(self, user_id: int, start: int, end: int):
+        """Mute the user every day from `start` to `end`, both minutes of the day in UTC."""
+        self.clear(user_id, deliver=False)
+        self.windows[user_id] = (start, end)
+        self.starts[start].add(user_id)
+        self.ends[end].add(user_id)
+        if in_silent_hours(start, end, self.cursor % MINUTES_PER_DAY):
+            self.muted.add(user_id)
+        else:
+            self.unmute(user_id)
 
-# # Save the current notify data to a JSON file
-# def save_times():
-#     with open('data/silent_hours.json', 'w') as f:
-#         # Write the dictionary to the JSON file
-#         json.dump(silent_hours, f)
+    def clear(self, user_id: int, deliver: bool = True):
+        window = self.windows.pop(user_id, None)
+        if window is None:
+            return
+        self.starts[window[0]].discard(user_id)
+        self.ends[window[1]].discard(user_id)
+        if deliver:
+            self.unmute(user_id)
+
+    def hold(self, user_id: int, channel_id: int, threshold: int):
+        channels = self.held.setdefault(user_id, {})
+        channels[channel_id] = max(threshold, channels.get(channel_id, 0))
+        metrics.increment("voicely_silenced_pings_total")
+
+    def unmute(self, user_id: int):
+        self.muted.discard(user_id)
+        held = self.held.pop(user_id, None)
+        if held is not None:
+            asyncio.create_task(deliver_held_pings(user_id, held))
+
+    def advance(self):
+        """Turn the wheel up to the current minute."""
+        now = current_minute()
+        if now - self.cursor >= MINUTES_PER_DAY: #Asleep for a whole day, so every window has to be checked again
+            self.cursor = now
+            for user_id, (start, end) in self.windows.items():
+                if in_silent_hours(start, end, now % MINUTES_PER_DAY):
+                    self.muted.add(user_id)
+                else:
+                    self.unmute(user_id)
+            return
+        while self.cursor < now:
+            self.cursor += 1
+            slot = self.cursor % MINUTES_PER_DAY
+            for user_id in self.ends[slot]:
+                self.unmute(user_id)
+            self.muted.update(self.starts[slot])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(60 - time.time() % 60)
+            self.advance()
+
+silent_hours = SilentHours()
+
+def apply_silent_hours(user_id: int, value: str | None):
+    """Put a user's saved silent hours on the wheel, or take them off if they have none."""
+    if value is None:
+        silent_hours.clear(user_id)
+        return
+    # The "silent_hours" setting is "start-end": the times from parse_time, moved to UTC with the offset from
+    # parse_utc_offset, as minutes of the day. The offset is kept apart in "utc_offset", only to fill in the modal.
+    start, end = value.split("-")
+    silent_hours.set(user_id, int(start), int(end))
+
+for user_id_str, settings in user_settings.items():
+    if "silent_hours" in settings:
+        apply_silent_hours(int(user_id_str), settings["silent_hours"])
+
+async def deliver_held_pings(user_id: int, held: dict[int, int]):
+    """Send the pings held back during a user's silent hours, for the channels that are still busy enough, as one message."""
+    async def release(channel_id: int, threshold: int):
+        members = bot.voice_members.get(channel_id, {})
+        if len(members) < threshold or user_id in members or channel_id not in bot.channel_contents:
+            return
+        if bot.get_notifications(user_id, channel_id) is not None: #Pinged for it before their window started, and that message has been kept up to date
+            return
+        channel_pings = pings.get(channel_id)
+        if channel_pings is None or user_id not in channel_pings.subscribers.get(threshold, ()): #The ping was removed in the meantime
+            return
+        notified_counts = bot.ensure_notifications(user_id, channel_id, channel_pings.guild_id)
+        notified_counts[threshold] = None
+        digests.add(user_id, DigestEntry(channel_id, notified_counts, threshold, []))
 
+    await asyncio.gather(*(channel_actors.submit(channel_id, partial(release, channel_id, threshold)) for channel_id, threshold in held.items()))
+    digests.flush(user_id)
 # endregion
 
 # endregion
 
 # region get ephemeral
-def return_bool(value: str):
-    if value.strip().lower() in ['true', '1', 'yes', 'y']:
-        return True
-    elif value.strip().lower() in ['false', '0', 'no', 'n']:
-        return False
-    else:
-        raise ValueError("Invalid input for boolean conversion.")
-
 def get_ephemeral(guild_id_str: str):
     if guild_id_str in server_settings and "ephemeral" in server_settings[guild_id_str]:
         return not return_bool(server_settings[guild_id_str]["ephemeral"])
@@ -146,8 +1519,128 @@ def get_ephemeral(guild_id_str: str):
 @bot.event
 async def on_ready():
     """Triggered when the bot has successfully connected to Discord."""
+    # Voice state updates may have been missed while disconnected, so count everyone again
+    counted: dict[int, tuple[int | None, dict[int, None]]] = {}
+    for guild in bot.guilds:
+        if not guild.unavailable:
+            for channel_id, member_ids in bot.count_voice_members(guild).items():
+                counted[channel_id] = (guild.id, member_ids)
+
+    # Channels that weren't counted, e.g. because they were deleted while the bot was offline, are now empty
+    for channel_id in list(bot.voice_members) + list(bot.notified_by_channel):
+        if channel_id in counted:
+            continue
+        guild_id = bot.notification_guilds.get(channel_id)
+        guild = bot.get_guild(guild_id or 0)
+        if guild is not None and guild.unavailable: #Its channels can't be seen during an outage, so check again later
+            continue
+        counted[channel_id] = (guild_id, {})
+
+    await recount_channels(counted)
+    bot.voice_counted = True
     print(f'Logged in as {bot.user}')
 
+@bot.event
+async def on_guild_join(guild: discord.Guild):
+    await recount_channels({channel_id: (guild.id, member_ids) for channel_id, member_ids in bot.count_voice_members(guild).items()})
+
+# region stale pings
+def removed_stale_pings(reason: str, removed: int):
+    if removed > 0:
+        metrics.increment("voicely_stale_pings_removed_total", (("reason", reason),), removed)
+
+# These run in the channel's actor, so they can't interleave with a voice event for the same channel
+async def delete_channel(channel_id: int, reason: str):
+    removed_stale_pings(reason, remove_channel_pings(channel_id))
+    forget_channel(channel_id)
+
+async def remove_member(guild_id: int, channel_id: int, user_id: int):
+    removed_stale_pings("member", remove_member_pings(guild_id, channel_id, user_id))
+    bot.pop_user_notifications(user_id, channel_id)
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    await channel_actors.submit(channel.id, partial(delete_channel, channel.id, "channel"))
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    channel_ids = set(guild_channels.get(guild.id, ()))
+    channel_ids.update(channel_id for channel_id, guild_id in bot.notification_guilds.items() if guild_id == guild.id)
+    channel_ids.update(channel.id for channel in guild.voice_channels + guild.stage_channels)
+    await asyncio.gather(*(channel_actors.submit(channel_id, partial(delete_channel, channel_id, "guild")) for channel_id in channel_ids))
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    # Only received with the members intent, so in lean mode departed members are left to the sweep, which can't
+    # see them either, and their pings stay until they remove them
+    guild_id = member.guild.id
+    channel_ids = member_channels(guild_id, member.id)
+    channel_ids.update(channel_id for channel_id in bot.notified_channels.get(member.id, {}) if bot.notification_guilds.get(channel_id) == guild_id)
+    await asyncio.gather(*(channel_actors.submit(channel_id, partial(remove_member, guild_id, channel_id, member.id)) for channel_id in channel_ids))
+
+async def sweep_channel(channel_id: int, cursor: tuple[int, int] | None, limit: int):
+    """
+    Remove the pings and notifications of one channel if it or its guild is gone, and check up to `limit` of its pings
+    after `cursor`, a (count, user_id), for members who left. Runs in the channel's actor. Returns how many entries
+    were checked and the cursor to carry on from, which is None once the channel is done.
+    """
+    channel = pings.get(channel_id)
+    guild_id = channel.guild_id if channel is not None else bot.notification_guilds.get(channel_id)
+    if guild_id is None: #Removed while the sweep was waiting
+        return 1, None
+    guild = bot.get_guild(guild_id)
+    if guild is not None and guild.unavailable: #Its channels can't be seen during an outage, so check again later
+        return 1, None
+    if guild is None or guild.get_channel(channel_id) is None:
+        reason = "guild" if guild is None else "channel"
+        removed_stale_pings(reason, remove_channel_pings(channel_id))
+        forget_channel(channel_id)
+        return 1, None
+
+    # Departed members can only be told apart from uncached ones once every member has been received
+    if channel is None or not bot.intents.members or not guild.chunked:
+        return 1, None
+    checked = 0
+    thresholds = channel.thresholds
+    for count in thresholds[bisect_left(thresholds, cursor[0]) if cursor is not None else 0:]:
+        user_ids = channel.subscribers[count]
+        start = bisect_right(user_ids, cursor[1]) if cursor is not None and count == cursor[0] else 0
+        # Copied, since removing a ping changes the array
+        for user_id in user_ids[start:start + limit - checked].tolist():
+            if guild.get_member(user_id) is None:
+                remove_ping(guild_id, channel_id, count, user_id)
+                removed_stale_pings("member", 1)
+                bot.pop_user_notifications(user_id, channel_id)
+            checked += 1
+            if checked >= limit:
+                return checked, (count, user_id)
+    return max(checked, 1), None
+
+async def sweep_stale_pings():
+    """
+    Catch what the delete and remove events missed, e.g. while the bot was offline. Each pass walks a snapshot of the
+    channels with pings or notifications, skipping the ones removed since, and checks each in its actor. At most
+    SWEEP_BATCH entries are checked at a time, yielding to the event loop between batches, and the sweep rests between
+    full passes.
+    """
+    await bot.wait_until_ready()
+    while True:
+        channel_ids = list(pings)
+        channel_ids.extend(channel_id for channel_id in bot.notification_guilds if channel_id not in pings)
+        checked = 0
+        for channel_id in channel_ids:
+            cursor = None
+            while channel_id in pings or channel_id in bot.notification_guilds:
+                checked_now, cursor = await channel_actors.submit(channel_id, partial(sweep_channel, channel_id, cursor, SWEEP_BATCH - checked))
+                checked += checked_now
+                if checked >= SWEEP_BATCH:
+                    checked = 0
+                    await asyncio.sleep(SWEEP_INTERVAL_MS / 1000)
+                if cursor is None:
+                    break
+        await asyncio.sleep(SWEEP_PASS_INTERVAL_MS / 1000)
+# endregion
+
 # region views and modals
 
 # region add ping
@@ -249,25 +1742,13 @@ class AddPingCountModal(discord.ui.Modal, title="Specify member count"):
                 await interaction.response.send_message(error_message, ephemeral=True)
                 return
             
-            notify_str = str(notify_count)
-            
-            guild_id = str(interaction.guild_id)
-            user_id = str(interaction.user.id)
-            # Add the user to the notification set for the guild
-            if guild_id not in pings:
-                pings[guild_id] = {}
-            # if user_id not in pings[guild_id]:
-            #     pings[guild_id][user_id] = {}
+            guild_id = interaction.guild_id
+            user_id = interaction.user.id
 
+            profile = start_profile("add_ping")
             for channel in self.channels:
-                channel_id = str(channel.id)
-                if channel_id not in pings[guild_id]:
-                    pings[guild_id][channel_id] = {}
-                if notify_str not in pings[guild_id][channel_id]:
-                    pings[guild_id][channel_id][notify_str] = []
-                
-                if user_id not in pings[guild_id][channel_id][notify_str]:
-                    pings[guild_id][channel_id][notify_str].append(user_id)
+                # Add the user to the notification list for the channel and count
+                add_ping(guild_id, channel.id, notify_count, user_id)
 
                 # region example
                 # This dictionary will look something like this:
@@ -295,8 +1776,6 @@ class AddPingCountModal(discord.ui.Modal, title="Specify member count"):
                 # }
                 # endregion
 
-            save_pings()
-
             if len(self.channels) > 1:
                 plural = "s"
                 channel = "any of the following channels"
@@ -320,8 +1799,13 @@ class AddPingCountModal(discord.ui.Modal, title="Specify member count"):
             # channel_list = discord.Embed(description=self.links)
 
             all_embeds = [confirmation_embed] + channel_embeds
-            # Respond to the user with the text they entered.
-            await interaction.response.send_message(embeds=all_embeds, ephemeral=get_ephemeral(guild_id))
+            profile.phase("persistence")
+            try:
+                # Respond to the user with the text they entered.
+                await interaction.response.send_message(embeds=all_embeds, ephemeral=get_ephemeral(str(guild_id)))
+                profile.phase("send")
+            finally:
+                finish_profile(profile, f"user {user_id}, {len(self.channels)} channels")
 
 class OpenModalView(discord.ui.View):
     def __init__(self, channels: List[discord.app_commands.AppCommandChannel], links: List[str]):
@@ -335,6 +1819,10 @@ class OpenModalView(discord.ui.View):
 # endregion
 
 # region remove ping
+# Each page of the remove menu has four dropdowns of 25 pings, leaving the last row for the navigation buttons
+SELECT_SIZE = 25
+PAGE_SIZE = 4 * SELECT_SIZE
+
 def remove_ping_embed(page: int, pages: int):
     title = "Remove pings"
     description = "Choose from the dropdowns below to remove those pings."
@@ -346,32 +1834,49 @@ def remove_ping_embed(page: int, pages: int):
     # else:
         # title = "Remove pings"
     return embed
-    
+
+def get_select_pages(ping_count: int):
+    # Up to five full dropdowns fit on a single page when there are no navigation buttons
+    if ping_count <= 5 * SELECT_SIZE:
+        return 1
+    return math.ceil(ping_count / PAGE_SIZE)
+
+class PingNames:
+    """Resolves server and channel names for the pings on one page, looking each server and channel up only once."""
+    def __init__(self):
+        self.guilds: dict[int, str] = {}
+        self.channels: dict[int, str] = {}
+
+    def guild(self, guild_id: int):
+        name = self.guilds.get(guild_id)
+        if name is None:
+            guild = bot.get_guild(guild_id)
+            name = guild.name if guild is not None else f"Unknown server ({guild_id})"
+            self.guilds[guild_id] = name
+        return name
+
+    def channel(self, channel_id: int):
+        name = self.channels.get(channel_id)
+        if name is None:
+            channel = bot.get_channel(channel_id)
+            name = channel.name if channel is not None else f"Deleted channel ({channel_id})"
+            self.channels[channel_id] = name
+        return name
 
 class RemovePingSelect(discord.ui.Select):    
-    def setup_select(self, options_dict: List[dict]):
+    def setup_select(self, subscriptions: List[tuple[int, int, int]], names: PingNames):
         options: List[discord.SelectOption] = []
-        for dict in options_dict:
-            # channel_str = dict["channel_str"]
-            count_str = dict["count_str"]
-            try:
-                count = int(count_str)
-            except:
-                print(f"Error converting {count_str} to an int.")
-                count = None
-            
-            if count is None:
-                plural = "(s)"
-            elif count > 1:
+        for guild_id, channel_id, count in subscriptions:
+            if count > 1:
                 plural = "s"
             else:
                 plural = ""
-            options.append(discord.SelectOption(label=f"{dict['channel_name']}: {count_str} member{plural}", value=f"{dict['guild_str']}/{dict['channel_str']}/{count_str}", description=dict["guild_name"]))
+            options.append(discord.SelectOption(label=f"{names.channel(channel_id)}: {count} member{plural}", value=f"{guild_id}/{channel_id}/{count}", description=names.guild(guild_id)))
         return options
         
-    def set_placeholder(self, options: List[dict]):
-        start_guild: str = options[0]["guild_name"]
-        end_guild: str = options[len(options) - 1]["guild_name"]
+    def set_placeholder(self, subscriptions: List[tuple[int, int, int]], names: PingNames):
+        start_guild = names.guild(subscriptions[0][0])
+        end_guild = names.guild(subscriptions[-1][0])
 
         if start_guild == end_guild:
             return f"Pings in {start_guild}"
@@ -379,8 +1884,8 @@ class RemovePingSelect(discord.ui.Select):
             return f"Servers {start_guild} to {end_guild}"
     
 
-    def __init__(self, options: List[discord.SelectOption], index: int):
-        super().__init__(min_values=1, max_values=len(options), options = self.setup_select(options), placeholder=self.set_placeholder(options))
+    def __init__(self, subscriptions: List[tuple[int, int, int]], names: PingNames):
+        super().__init__(min_values=1, max_values=len(subscriptions), options = self.setup_select(subscriptions, names), placeholder=self.set_placeholder(subscriptions, names))
 
 
     async def callback(self, interaction: discord.Interaction):
@@ -390,20 +1895,11 @@ class RemovePingSelect(discord.ui.Select):
         
         for value in self.values:
             values = value.split('/')
-            guild_id = values[0]
-            channel_id = values[1]
-            count_str = values[2]
-
-            pings[guild_id][channel_id][count_str].remove(str(interaction.user.id))
-
-            if len(pings[guild_id][channel_id][count_str]) == 0:
-                del pings[guild_id][channel_id][count_str]
-            if len(pings[guild_id][channel_id]) == 0:
-                del pings[guild_id][channel_id]
-            if len(pings[guild_id]) == 0:
-                del pings[guild_id]
+            guild_id = int(values[0])
+            channel_id = int(values[1])
+            count = int(values[2])
 
-        save_pings()
+            remove_ping(guild_id, channel_id, count, interaction.user.id)
 
         ping_count = len(self.values)
         if ping_count > 1:
@@ -416,117 +1912,624 @@ class NavigationType(Enum):
     next = "next"
     previous = "previous"
 
-def get_select_pages(all_options: List[dict]):
-    select_count = math.ceil(len(all_options) / 25)
-    if select_count == 5:
-        pages = 1
-    else:
-        pages = math.ceil(select_count / 4)
-
-    return pages
-
 class NavigationButton(discord.ui.Button):
-    def __init__(self, navigation_type: NavigationType, all_options: List[dict], page: int, pages: int):
-        self.all_options = all_options
-        self.page = page
-        self.pages = pages
+    def __init__(self, navigation_type: NavigationType, user_id: int, cursor: tuple[int, int, int]):
+        # The page is found again from the ping it starts or ends at, so it stays right if pings were removed meanwhile
+        self.navigation_type = navigation_type
+        self.user_id = user_id
+        self.cursor = cursor
         if navigation_type == NavigationType.next:
             # print('got here')
             label = "Next Page"
             # emoji = "⏩"
-            self.next_page = self.page + 1
         elif navigation_type == NavigationType.previous:
             label = "Previous Page"
             # emoji = "⏪"
-            self.next_page = self.page - 1
         super().__init__(label=label)
 
     async def callback(self, interaction: discord.Interaction):
-        await interaction.response.send_message(embed=remove_ping_embed(self.next_page, self.pages), view=RemovePingView(self.all_options, self.next_page), ephemeral=True)
+        subscriptions = await removable_pings(self.user_id)
+        if self.navigation_type == NavigationType.next: #The cursor is the first ping of the next page
+            start = bisect_left(subscriptions, self.cursor)
+        else: #The cursor is the first ping of the current page
+            start = max(0, bisect_left(subscriptions, self.cursor) - PAGE_SIZE)
+        view = RemovePingView(self.user_id, subscriptions, start)
+        if view.count == 0:
+            await interaction.response.send_message(f'You have not set up any pings to remove.', ephemeral=True)
+            return
+        await interaction.response.send_message(embed=remove_ping_embed(view.page, view.pages), view=view, ephemeral=True)
 
 
+async def removable_pings(user_id: int):
+    """Return a user's pings, sorted. With clusters, the other clusters' pings are only in the shared database."""
+    if len(SHARD_IDS) == 0:
+        return user_subscriptions.get(user_id, [])
+    return UserPings(sorted(await storage.subscriptions_for_user(user_id)))
+
 class RemovePingView(discord.ui.View):
-    # pages = 0
-    # # select_count = 0
-    # all_options: List[dict] = []
-    # count = 0
-    # page = 0
-    def __init__(self, options: List[dict], page: int):
+    """One page of a user's pings, starting at position `start` of their sorted pings. Only this page is built."""
+    def __init__(self, user_id: int, subscriptions: UserPings | List[tuple[int, int, int]], start: int):
         super().__init__()
-        self.all_options = options
-        self.page = page
-        self.pages = get_select_pages(options)
-
-        self.index = page * 4 * 25
+        self.user_id = user_id
+        self.pages = get_select_pages(len(subscriptions))
+        if self.pages == 1:
+            start = 0
+            end = len(subscriptions)
+        else:
+            start = min(start, (self.pages - 1) * PAGE_SIZE)
+            end = min(start + PAGE_SIZE, len(subscriptions))
+        self.page = math.ceil(start / PAGE_SIZE)
 
+        names = PingNames()
         self.count = 0
-        
-        def add_option():
-            options = self.all_options[self.index:min(self.index + 25, len(self.all_options))]
-            select = RemovePingSelect(options, self.index)
-            self.add_item(select)
-            self.index += 25
+        for index in range(start, end, SELECT_SIZE):
+            self.add_item(RemovePingSelect(subscriptions[index:min(index + SELECT_SIZE, end)], names))
             self.count += 1
 
-        
-        while (self.index < len(self.all_options)) and (self.count < 4):
-            add_option()
-        
-        if self.pages == 1 and self.index < len(self.all_options):
-            add_option()
-        
-        self.add_navigation()
-
-    def add_navigation(self):
         if self.pages > 1:
-            if self.page < self.pages - 1:
-                self.add_item(NavigationButton(NavigationType.next, self.all_options, self.page, self.pages))
-            if self.page != 0:
-                self.add_item(NavigationButton(NavigationType.previous, self.all_options, self.page, self.pages))
+            if end < len(subscriptions):
+                self.add_item(NavigationButton(NavigationType.next, user_id, subscriptions[end]))
+            if start > 0:
+                self.add_item(NavigationButton(NavigationType.previous, user_id, subscriptions[start]))
         
 # endregion
 
 # region silent hours
-# class SilentHoursStart(discord.ui.View):
-#     def __init__(self, channels: List[discord.app_commands.AppCommandChannel], links: List[str]):
-#         super().__init__()
-#         self.channels = channels
-#         self.links = links
-    
-#     @discord.ui.button(label="Continue")
-#     async def open_modal(self, interaction: discord.Interaction, button: discord.ui.Button):
-#         await interaction.response.send_modal(AddPingCountModal(self.channels, self.links))
+TIME_FORMATS = ("%I:%M %p", "%I:%M%p", "%I %p", "%I%p", "%H:%M")
 
+def parse_time(value: str):
+    """Return the minute of the day for a time like `10:30 PM` or `22:30`, or None if it isn't one."""
+    for time_format in TIME_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(value.strip().upper(), time_format)
+        except ValueError:
+            continue
+        return parsed.hour * 60 + parsed.minute
+    return None
+
+def parse_utc_offset(value: str):
+    """Return the offset in minutes for an offset like `-5`, `+5:30` or `UTC+1`, or None if it isn't one."""
+    value = value.strip().upper().removeprefix("UTC").removeprefix("GMT").strip()
+    if value == "":
+        return 0
+    sign = -1 if value.startswith("-") else 1
+    hours, _, minutes = value.lstrip("+-").partition(":")
+    try:
+        offset = int(hours) * 60 + (int(minutes) if minutes else 0)
+    except ValueError:
+        return None
+    if offset > 14 * 60 or (minutes and not 0 <= int(minutes) < 60):
+        return None
+    return sign * offset
+
+def format_time(minute_of_day: int):
+    return datetime.time(minute_of_day // 60, minute_of_day % 60).strftime("%I:%M %p").lstrip("0")
+
+def next_timestamp(minute_of_day: int):
+    """The unix time of the next time it is this minute of the day in UTC."""
+    now = current_minute()
+    return (now + (minute_of_day - now) % MINUTES_PER_DAY) * 60
+
+class SilentHoursModal(discord.ui.Modal, title="Set silent hours"):
+    def __init__(self, user_id: int):
+        super().__init__()
+        # Fill in the window the user has now, in the time zone they entered it in
+        settings = user_settings.get(str(user_id), {})
+        if "silent_hours" in settings:
+            offset = int(settings.get("utc_offset", "0"))
+            start, end = (int(minute) for minute in settings["silent_hours"].split("-"))
+            self.start_time.default = format_time((start + offset) % MINUTES_PER_DAY)
+            self.end_time.default = format_time((end + offset) % MINUTES_PER_DAY)
+            self.utc_offset.default = f"{'-' if offset < 0 else '+'}{abs(offset) // 60}:{abs(offset) % 60:02}"
+
+    start_time = discord.ui.TextInput(
+        label="Start time",
+        placeholder="e.g. 10:00 PM, leave empty to turn silent hours off",
+        max_length=8,
+        required=False,
+        style=discord.TextStyle.short
+    )
 
-# class SilentHoursModal(discord.ui.Modal, title="Specify member count"):
-#     def __init__(self, channels: List[discord.app_commands.AppCommandChannel], links: List[str]):
-#         super().__init__()
-    
+    end_time = discord.ui.TextInput(
+        label="End time",
+        placeholder="e.g. 7:00 AM",
+        max_length=8,
+        required=False,
+        style=discord.TextStyle.short
+    )
+
+    utc_offset = discord.ui.TextInput(
+        label="UTC offset (not adjusted for daylight saving)",
+        placeholder="e.g. -5 or +5:30",
+        max_length=9,
+        required=False,
+        style=discord.TextStyle.short
+    )
+
+    async def on_submit(self, interaction: discord.Interaction):
+        user_id = interaction.user.id
+        user_id_str = str(user_id)
+
+        if not self.start_time.value.strip() and not self.end_time.value.strip():
+            delete_user_setting(user_id_str, "silent_hours")
+            delete_user_setting(user_id_str, "utc_offset")
+            silent_hours.clear(user_id)
+            await interaction.response.send_message("Silent hours have been **turned off**. You will be pinged at any time.", ephemeral=True)
+            return
+
+        start = parse_time(self.start_time.value)
+        end = parse_time(self.end_time.value)
+        offset = parse_utc_offset(self.utc_offset.value)
+        if start is None or end is None:
+            await interaction.response.send_message(f"`{self.start_time.value}` to `{self.end_time.value}` is not a valid time range! Enter times like `10:00 PM` or `22:00`.", ephemeral=True)
+            return
+        if offset is None:
+            await interaction.response.send_message(f"`{self.utc_offset.value}` is not a valid UTC offset! Enter an offset like `-5` or `+5:30`.", ephemeral=True)
+            return
+        if start == end:
+            await interaction.response.send_message("The start and end times must be different!", ephemeral=True)
+            return
+
+        # Kept in UTC, so every user's window is on the same wheel
+        start = (start - offset) % MINUTES_PER_DAY
+        end = (end - offset) % MINUTES_PER_DAY
+        set_user_setting(user_id_str, "silent_hours", f"{start}-{end}")
+        set_user_setting(user_id_str, "utc_offset", str(offset))
+        silent_hours.set(user_id, start, end)
+
+        await interaction.response.send_message(f"Silent hours set! You will not be pinged from <t:{next_timestamp(start)}:t> to <t:{next_timestamp(end)}:t> every day. Pings for channels that are still busy when your silent hours end will be sent to you then.\n\nSilent hours use a fixed UTC offset, so set them again when your clocks change for daylight saving.", ephemeral=True)
+
+class SilentHoursView(discord.ui.View):
+    @discord.ui.button(label="Continue")
+    async def open_modal(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.send_modal(SilentHoursModal(interaction.user.id))
+# endregion
+
+# region outbound scheduler
+class Priority(Enum):
+    send = 0
+    edit = 1
+    delete = 2
+
+class OutboundJob:
+    __slots__ = ("priority", "route", "run", "message_id", "future", "cancelled")
+
+    def __init__(self, priority: Priority, route: tuple, run: Callable[[], Coroutine], message_id: int | None, future: asyncio.Future | None):
+        self.priority = priority
+        self.route = route
+        self.run = run
+        self.message_id = message_id # Set for edits, so newer edits to the same message can replace this one
+        self.future = future # Set for sends and deletes, whose result the caller waits for
+        self.cancelled = False
+
+class RouteBudget:
+    """A token bucket that allows `ROUTE_BURST` requests at once on a route, refilled at `ROUTE_RATE` per second."""
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, now: float):
+        self.tokens = ROUTE_BURST
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(ROUTE_BURST, self.tokens + (now - self.updated) * ROUTE_RATE)
+        self.updated = now
+
+    def take(self, now: float):
+        """Use up a request if one is available and return 0, otherwise return how many seconds until one is."""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / ROUTE_RATE
+
+class OutboundScheduler:
+    """
+    Every DM request goes through here, so the ones that matter most go first when Discord is rate limiting us.
+    Queued requests run by priority (sends, then edits, then deletes), with a rate budget for each route.
+    A newer edit replaces a queued edit to the same message, and deleting a message cancels its queued edits.
+    """
+    def __init__(self, worker_count: int):
+        self.worker_count = worker_count
+        self.workers: List[asyncio.Task] = []
+        self.queue: list[tuple[int, int, OutboundJob]] = [] # A heap of (priority, sequence, job)
+        self.sequence = 0
+        self.ready = asyncio.Semaphore(0)
+        self.edits: dict[int, OutboundJob] = {} # Queued edits that haven't started yet, {message_id: job}
+        self.budgets: dict[tuple, RouteBudget] = {}
+        self.unfinished = 0
+        self.deferred = 0 # Jobs put aside until their route's budget refills, which aren't in the queue meanwhile
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    # region submitting
+    def push(self, job: OutboundJob):
+        heapq.heappush(self.queue, (job.priority.value, self.sequence, job))
+        self.sequence += 1
+        self.ready.release()
+
+    def push_deferred(self, job: OutboundJob):
+        self.deferred -= 1
+        self.push(job)
+
+    def submit(self, priority: Priority, route: tuple, run: Callable[[], Coroutine], message_id: int | None = None, future: asyncio.Future | None = None, after: List[asyncio.Future] = ()):
+        """Queue a request. With `after`, it only joins the queue once those futures are done, but still counts as unfinished meanwhile."""
+        if len(self.workers) == 0:
+            self.workers = [asyncio.create_task(self.work()) for _ in range(self.worker_count)]
+        job = OutboundJob(priority, route, run, message_id, future)
+        self.unfinished += 1
+        self.idle.clear()
+        if len(after) > 0:
+            asyncio.gather(*after, return_exceptions=True).add_done_callback(lambda _: self.push(job))
+        else:
+            self.push(job)
+        return job
+
+    def route(self, user_id: int):
+        """DMs to the same channel share a rate limit, so a user's requests are keyed on their DM channel once it's known."""
+        dm_channel_id = bot.dm_channels.peek(user_id)
+        if dm_channel_id is not None:
+            return ("channel", dm_channel_id)
+        return ("user", user_id)
+
+    def send(self, user_id: int, run: Callable[[], Coroutine], after: List[asyncio.Future] = ()):
+        """Queue a new ping, once the deletes in `after` are done. Returns a future with the result of `run`."""
+        future = asyncio.get_running_loop().create_future()
+        self.submit(Priority.send, self.route(user_id), run, future=future, after=after)
+        return future
+
+    def edit(self, record: NotificationRecord, content: str):
+        queued = self.edits.get(record.message_id)
+        if queued is not None: #Only the newest content matters, so replace the edit that is already waiting
+            queued.run = partial(record.partial_message().edit, content=content)
+            return
+        self.edits[record.message_id] = self.submit(Priority.edit, ("channel", record.channel_id), partial(record.partial_message().edit, content=content), message_id=record.message_id)
+
+    def cancel_edit(self, message_id: int):
+        queued = self.edits.pop(message_id, None)
+        if queued is not None:
+            queued.cancelled = True
+
+    def delete(self, record: NotificationRecord):
+        """Queue deleting a ping. Returns a future that is done once it has been deleted or failed to be."""
+        self.cancel_edit(record.message_id)
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(partial(self.report_failed_delete, record))
+        self.submit(Priority.delete, ("channel", record.channel_id), record.partial_message().delete, future=future)
+        return future
+
+    def report_failed_delete(self, record: NotificationRecord, future: asyncio.Future):
+        # e.g. the user already deleted it, which mustn't stop the ping replacing it
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Could not delete ping {record.message_id}: {future.exception()}")
+    # endregion
+
+    # region running
+    def budget(self, route: tuple, now: float):
+        budget = self.budgets.get(route)
+        if budget is None:
+            if len(self.budgets) >= 10000: #Forget the routes that have fully refilled, so this doesn't grow forever
+                for other_route, other_budget in list(self.budgets.items()):
+                    other_budget.refill(now)
+                    if other_budget.tokens >= ROUTE_BURST:
+                        del self.budgets[other_route]
+            budget = RouteBudget(now)
+            self.budgets[route] = budget
+        return budget
+
+    def finish(self):
+        self.unfinished -= 1
+        if self.unfinished == 0:
+            self.idle.set()
+
+    async def work(self):
+        while True:
+            await self.ready.acquire()
+            _, _, job = heapq.heappop(self.queue)
+            if job.cancelled:
+                self.finish()
+                continue
+
+            now = time.monotonic()
+            wait = self.budget(job.route, now).take(now)
+            if wait > 0: #This route is out of budget, so put the job back once it has refilled and run something else
+                self.deferred += 1
+                asyncio.get_running_loop().call_later(wait, self.push_deferred, job)
+                continue
+
+            if job.message_id is not None and self.edits.get(job.message_id) is job:
+                del self.edits[job.message_id]
+            try:
+                result = await job.run()
+            except Exception as error:
+                metrics.increment("voicely_dm_requests_total", (("kind", job.priority.name), ("result", "failed")))
+                if job.future is not None:
+                    job.future.set_exception(error)
+                else:
+                    print(f"Could not {job.priority.name} message {job.route}: {error}")
+            else:
+                metrics.increment("voicely_dm_requests_total", (("kind", job.priority.name), ("result", "ok")))
+                if job.future is not None:
+                    job.future.set_result(result)
+            finally:
+                self.finish()
+
+    async def drain(self):
+        """Wait until every queued request has run."""
+        await self.idle.wait()
+    # endregion
+
+outbound = OutboundScheduler(DM_CONCURRENCY)
+# endregion
+
+# region channel actors
+class ChannelActors:
+    """
+    Runs the changes to each voice channel one at a time, in the order the events arrived, while different channels run
+    in parallel. Pings are only queued, not waited for, so a slow send doesn't hold up the channel's next event. A
+    channel's queue and worker go away as soon as the queue is empty.
+    """
+    def __init__(self):
+        self.queues: dict[int, deque] = {}
+        self.workers: set[asyncio.Task] = set()
+
+    def submit(self, channel_id: int, run: Callable[[], Coroutine]):
+        """Queue a change for this channel and return a future for its result."""
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(channel_id)
+        if queue is None:
+            queue = deque()
+            self.queues[channel_id] = queue
+            worker = asyncio.create_task(self.work(channel_id, queue))
+            self.workers.add(worker)
+            worker.add_done_callback(self.workers.discard)
+        queue.append((run, future))
+        return future
+
+    async def work(self, channel_id: int, queue: deque):
+        while len(queue) > 0:
+            run, future = queue.popleft()
+            try:
+                result = await run()
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                if not future.done():
+                    future.set_result(result)
+        # Nothing can be queued between the check above and here, since there's no await in between
+        del self.queues[channel_id]
+
+    async def drain(self):
+        """Wait until every queued change has run."""
+        while len(self.workers) > 0:
+            await asyncio.gather(*self.workers, return_exceptions=True)
+
+channel_actors = ChannelActors()
+# endregion
 
-#     start_time = discord.ui.TextInput(
-#         label="Start time",
-#         placeholder="Enter a start time in ",
-#         max_length=3,
-#         style=discord.TextStyle.short
-#     )
+# region edit coalescing
+class EditCoalescer:
+    """Collects notification edits per channel, and only sends the latest content for each message once the window has passed."""
+    def __init__(self, window: float):
+        self.window = window
+        self.pending: dict[int, dict[int, tuple[NotificationRecord, str]]] = {}
+        # {channel_id: {message_id: (record, content)}}
+        self.flushes: dict[int, asyncio.Task] = {}
+
+    def queue(self, channel_id: int, record: NotificationRecord, content: str):
+        """Replace any pending edit to this message with `content`, and schedule a flush for the channel if there isn't one yet."""
+        record.update(channel_id, content)
+        self.pending.setdefault(channel_id, {})[record.message_id] = (record, content)
+        if channel_id not in self.flushes:
+            self.flushes[channel_id] = asyncio.create_task(self.flush_later(channel_id))
+
+    def discard(self, channel_id: int, message_id: int):
+        """Drop a pending edit, e.g. because the message is about to be deleted."""
+        pending = self.pending.get(channel_id)
+        if pending is not None:
+            pending.pop(message_id, None)
+        outbound.cancel_edit(message_id)
+
+    async def flush_later(self, channel_id: int):
+        await asyncio.sleep(self.window)
+        del self.flushes[channel_id]
+        self.flush(channel_id)
+
+    def flush(self, channel_id: int):
+        for record, content in self.pending.pop(channel_id, {}).values():
+            # A digest is rendered now rather than when the edit was queued, so it has every channel's latest content
+            outbound.edit(record, record.text(content))
+
+    def flush_all(self):
+        for task in self.flushes.values():
+            task.cancel()
+        self.flushes.clear()
+        for channel_id in list(self.pending):
+            self.flush(channel_id)
+
+edit_coalescer = EditCoalescer(EDIT_WINDOW_MS / 1000)
+
+def forget_channel(channel_id: int):
+    """Drop everything kept about a voice channel that no longer exists. Its pings are left as they are."""
+    bot.voice_members.pop(channel_id, None)
+    bot.channel_contents.pop(channel_id, None)
+    for counts in bot.pop_channel_notifications(channel_id).values():
+        for record in counts.values():
+            if record is not None:
+                edit_coalescer.discard(channel_id, record.message_id)
+    cooldowns.forget(channel_id)
+
+def left_content(last_content: str):
+    """Turn a "... currently in" message into one saying who was last in the channel and when they left."""
+    left_at = f".\n-# Last member left at <t:{str(datetime.datetime.now().timestamp())[:10]}:t>."
+    return last_content.replace("is currently", "was").replace("are currently", "were") + left_at
+
+def reset_channel_notifications(channel_id: int):
+    """Edit every ping for this channel to say everyone has left, and forget them so the next person to join pings again."""
+    last_content = bot.channel_contents.pop(channel_id, None)
+    popped = bot.pop_channel_notifications(channel_id)
+    for counts in popped.values(): #For each person who has been notified for this channel
+        for record in counts.values():
+            if record is not None and last_content is not None: #If message exists
+                # This replaces any roster edit still waiting for this message
+                edit_coalescer.queue(channel_id, record, left_content(last_content))
+    # Keep the messages of anyone still in their cooldown, so they can be picked up again if the channel refills
+    cooldowns.park(channel_id, popped)
+# endregion
+
+# region ping cooldowns
+class PingCooldowns:
+    """
+    When each subscriber was last sent a ping for each channel, and the messages of recently emptied channels. A ping
+    within the cooldown reuses the message the subscriber already has, which is then edited with the new roster.
+    Entries are only checked against the clock when they're used, and old ones are dropped when their channel empties.
+    Only this time based form of re-arming is implemented. Re-arming once a channel drops k below the count isn't.
+    The requests this saves are counted in voicely_suppressed_requests_total.
+    """
+    def __init__(self, cooldown: float):
+        self.cooldown = cooldown
+        self.sent: dict[int, dict[int, float]] = {}
+        # {channel_id: {user_id: time.monotonic() of the last ping sent}}
+        self.parked: dict[int, dict[int, List[NotificationRecord]]] = {}
+        # {channel_id: {user_id: [records]}} for channels that emptied while these users were in their cooldown
+
+    def record_sent(self, channel_id: int, user_id: int):
+        if self.cooldown > 0:
+            self.sent.setdefault(channel_id, {})[user_id] = time.monotonic()
+
+    def cooling(self, channel_id: int, user_id: int):
+        sent_at = self.sent.get(channel_id, {}).get(user_id)
+        return sent_at is not None and time.monotonic() - sent_at < self.cooldown
+
+    def park(self, channel_id: int, by_user: dict[int, dict[int, NotificationRecord | None]]):
+        self.parked.pop(channel_id, None)
+        sent = self.sent.get(channel_id)
+        if sent is None:
+            return
+        now = time.monotonic()
+        for user_id, sent_at in list(sent.items()):
+            if now - sent_at >= self.cooldown:
+                del sent[user_id]
+        if len(sent) == 0:
+            del self.sent[channel_id]
+            return
+        parked = {user_id: [record for record in counts.values() if record is not None] for user_id, counts in by_user.items() if user_id in sent}
+        self.parked[channel_id] = {user_id: records for user_id, records in parked.items() if len(records) > 0}
+
+    def reuse(self, channel_id: int, user_id: int, notified_counts: dict[int, NotificationRecord | None] | None):
+        """
+        Return a message this user already has for the channel if they're in their cooldown, or None if a new ping
+        should be sent. A message that would have been deleted to make way for the new one is preferred.
+        """
+        if not self.cooling(channel_id, user_id):
+            return None
+        records = [record for record in (notified_counts or {}).values() if record is not None]
+        if len(records) > 0:
+            metrics.increment("voicely_suppressed_requests_total", (("kind", "delete"),), len(records))
+        else:
+            records = self.parked.get(channel_id, {}).pop(user_id, [])
+        if len(records) == 0:
+            return None
+        metrics.increment("voicely_suppressed_requests_total", (("kind", "send"),))
+        return records[0]
 
-#     async def on_submit(self, interaction: discord.Interaction):
-#         # if not self.notify_count.value:
-#         #     notify_count = bot.default_settings["notify_count"]
-#         # else:
+    def forget(self, channel_id: int):
+        self.sent.pop(channel_id, None)
+        self.parked.pop(channel_id, None)
 
-#         error_message = f"`{self.notify_count.value}` is not a valid number! Only positive whole numbers are allowed."
+cooldowns = PingCooldowns(PING_COOLDOWN_MS / 1000)
+# endregion
 
-# class TimeSelect(discord.ui.Select):
-#     def __init__(self):
-#         super().__init__(placeholder="Select one or more channels", min_values=1, max_values=25)
-#         self.channel_types = [discord.ChannelType.voice]
+# region digests
+# Digests stop taking more channels at this length, so later edits still fit in Discord's 2000 character limit
+DIGEST_MAX_LENGTH = 1500
 
-#     async def callback(self, interaction: discord.Interaction):
-#         if len(self.values) <= 0:
-#             await interaction.response.send_message(f"You must select at least one channel!", ephemeral=True)
-#             return
+class DigestEntry:
+    """A ping waiting to go out in a digest."""
+    __slots__ = ("channel_id", "notified_counts", "threshold", "to_delete")
 
+    def __init__(self, channel_id: int, notified_counts: dict, threshold: int, to_delete: List[NotificationRecord]):
+        self.channel_id = channel_id
+        self.notified_counts = notified_counts
+        self.threshold = threshold
+        self.to_delete = to_delete
+
+class DigestBatcher:
+    """
+    Collects the pings for users who turned on digests, and sends all of a user's pings from the same window as one
+    message with a section for each channel. The channels' roster updates then all edit that message.
+    """
+    def __init__(self, window: float):
+        self.window = window
+        self.pending: dict[int, List[DigestEntry]] = {}
+        self.timers: dict[int, asyncio.TimerHandle] = {}
+
+    def add(self, user_id: int, entry: DigestEntry):
+        entries = self.pending.get(user_id)
+        if entries is None:
+            entries = []
+            self.pending[user_id] = entries
+            self.timers[user_id] = asyncio.get_running_loop().call_later(self.window, self.flush, user_id)
+        entries.append(entry)
+
+    def flush(self, user_id: int):
+        timer = self.timers.pop(user_id, None)
+        if timer is not None: #Flushed before the window passed
+            timer.cancel()
+        entries = self.pending.pop(user_id, [])
+        if len(entries) > 0:
+            # The pings the digest replaces are deleted first, so the user only sees one message per channel at a time
+            deleted = [outbound.delete(record) for entry in entries for record in entry.to_delete]
+            for entry in entries:
+                entry.to_delete = []
+            outbound.send(user_id, partial(self.deliver, user_id, entries), after=deleted).add_done_callback(partial(self.report_error, user_id))
+
+    def flush_all(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        for user_id in list(self.pending):
+            self.flush(user_id)
+
+    def report_error(self, user_id: int, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Could not send digest to {user_id}: {future.exception()}")
+
+    async def deliver(self, user_id: int, entries: List[DigestEntry]):
+        # Channels that emptied while the digest was waiting are left out
+        live = [entry for entry in entries if bot.get_notifications(user_id, entry.channel_id) is entry.notified_counts and entry.channel_id in bot.channel_contents]
+        sections: dict[int, str] = {}
+        length = 0
+        for entry in live:
+            if entry.channel_id in sections:
+                continue
+            content = bot.channel_contents[entry.channel_id]
+            if len(sections) > 0 and length + len(content) > DIGEST_MAX_LENGTH: #Too long, so it goes in the next digest
+                self.add(user_id, entry)
+                continue
+            sections[entry.channel_id] = content
+            length += len(content) + 2
+        if len(sections) == 0:
+            return
+
+        message = await bot.send_dm(user_id, "\n\n".join(sections.values()))
+        if len(sections) > 1:
+            record = DigestRecord(message.channel.id, message.id, dict(sections))
+        else:
+            record = NotificationRecord(message.channel.id, message.id)
+        for entry in live:
+            if entry.channel_id in sections:
+                entry.notified_counts[entry.threshold] = record
+                storage.notifications_changed(entry.channel_id)
+
+        # Bring the channels that changed while the message was being sent up to date
+        for channel_id, sent_content in sections.items():
+            cooldowns.record_sent(channel_id, user_id)
+            if channel_id not in bot.channel_contents: #Everyone left in the meantime
+                edit_coalescer.queue(channel_id, record, left_content(sent_content))
+            elif bot.channel_contents[channel_id] != sent_content:
+                edit_coalescer.queue(channel_id, record, bot.channel_contents[channel_id])
+
+digests = DigestBatcher(DIGEST_WINDOW_MS / 1000)
 # endregion
 
 # region Reused errors
@@ -569,45 +2572,41 @@ async def add(ctx: commands.Context):
 async def remove(ctx: commands.Context):
     """Remove a ping that you previously set up."""
     # guild_id = str(ctx.guild.id)
-    user_id_str = str(ctx.author.id)
-    # Remove the user from the notification set for the guild, if they exist
-    # listed_pings = {}
-    options: List[dict] = []
-    for guild_id_str in pings:
-        for channel_id_str in pings[guild_id_str]:
-            for count_str in pings[guild_id_str][channel_id_str]:
-                if user_id_str in pings[guild_id_str][channel_id_str][count_str]:
-                    
-                    channel = bot.get_channel(int(channel_id_str))
-                    guild = bot.get_guild(int(guild_id_str))
-
-                    options.append({
-                        "guild_str": guild_id_str,
-                        "guild_name": guild.name,
-                        "channel_str": channel_id_str,
-                        "channel_name": channel.name,
-                        "count_str": count_str
-                    })
-    
-    if len(options) == 0:
-        await ctx.send(f'You have not set up any pings to remove.', reference=ctx.message, ephemeral=True)
-    else:
-        def sort_options(option):
-            guild_name: str = option["guild_name"]
-            channel_name: str = option["channel_name"]
+    user_id = ctx.author.id
+    profile = start_profile("remove_ping")
+    subscriptions = []
+    try:
+        subscriptions = await removable_pings(user_id)
+        # Only the first page is built, the rest are built when the user navigates to them
+        view = RemovePingView(user_id, subscriptions, 0)
+        profile.phase("lookup")
+        if view.count == 0:
+            await ctx.send(f'You have not set up any pings to remove.', reference=ctx.message, ephemeral=True)
+        else:
+            await ctx.send(embed=remove_ping_embed(view.page, view.pages), view=view, reference=ctx.message, ephemeral=True)
+        profile.phase("send")
+    finally:
+        finish_profile(profile, f"user {user_id}, {len(subscriptions)} pings")
 
-            count_str = option["count_str"]
+@ping.command()
+@app_commands.describe(value="Type 'true' to get your pings in digests, or 'false' to get each ping in its own message.")
+async def digest(ctx: commands.Context, value: return_stripped):
+    """Set whether pings for different channels that come close together are sent to you as one message."""
 
-            while len(count_str) < 3:
-                count_str = f"0{count_str}"
+    user_id_str = str(ctx.author.id)
 
-            return f"{guild_name} {channel_name} {count_str}"
+    if value == "true":
+        set_user_setting(user_id_str, "digest", value)
+        digest_users.add(ctx.author.id)
 
-        options.sort(key=sort_options)
-        # embed = discord.Embed(title="Remove pings", description=f"Choose from the dropdowns below to remove those pings.")
-        # view = RemovePingView(options, 0)
-        
-        await ctx.send(embed=remove_ping_embed(0, get_select_pages(options)), view=RemovePingView(options, 0), reference=ctx.message, ephemeral=True)
+        await ctx.send(f"Your pings will now be sent in **digests**. Pings that come within {DIGEST_WINDOW_MS / 1000:g} seconds of each other are sent as one message, which is kept up to date for every channel in it.", reference=ctx.message, ephemeral=True)
+    elif value == "false":
+        delete_user_setting(user_id_str, "digest")
+        digest_users.discard(ctx.author.id)
+
+        await ctx.send(f"Your pings will now each be sent in **their own message**.", reference=ctx.message, ephemeral=True)
+    else:
+        await ctx.send("`value` must be either `true` or `false`.\n\nType `true` to get your pings in digests, or `false` to get each ping in its own message.", reference=ctx.message, ephemeral=True)
 
 @bot.hybrid_command()
 @commands.has_permissions(administrator=True)
@@ -621,11 +2620,7 @@ async def visible(ctx: commands.Context, value: return_stripped):
         await ctx.send("`value` must be either `true`, `false`, or `reset`.\n\nType `true` to make responses visible, `false` to make them invisible, or `reset` to set to default.", reference=ctx.message, ephemeral=True)
         return
     elif value == "true" or value == "false":
-        if guild_id_str not in server_settings:
-            server_settings[guild_id_str] = {}
-        server_settings[guild_id_str]["ephemeral"] = value
-
-        save_server_settings()
+        set_server_setting(guild_id_str, "ephemeral", value)
 
         if value == "true":
             string = "visible"
@@ -634,40 +2629,19 @@ async def visible(ctx: commands.Context, value: return_stripped):
 
         await ctx.send(f"Command responses have been made **{string}** to all server members.\n\nThis will only affect the **final confirmations** of the `/ping add` and `/ping remove` commands.", reference=ctx.message, ephemeral=True)
     elif value == "reset":
-        if guild_id_str in server_settings and "ephemeral" in server_settings[guild_id_str]:
-            del server_settings[guild_id_str]["ephemeral"]
-        
-        if len(server_settings[guild_id_str]) == 0:
-            del server_settings[guild_id_str]
-
-        save_server_settings()
+        delete_server_setting(guild_id_str, "ephemeral")
 
         await ctx.send(f"The visibility of command responses has been **reset** to the bot's default: `{bot.default_settings['ephemeral']}`", reference=ctx.message, ephemeral=True)
 
 
-# @bot.hybrid_group()
-# async def set(ctx: commands.Context):
-#     """Various personal settings."""
-
-#     if ctx.invoked_subcommand is None:
-#         await ctx.send(f"{ctx.invoked_subcommand} is not a valid subcommand.", reference=ctx.message, ephemeral=True)
-
-
-# def return_time(argument: str):
-#     try:
-#         datetime.datetime.strptime(argument, '%I:%M %p')
-#     except:
-#         return argument.lower()
-    
-# def return_weekday(argument: str):
-
-
-
-# @bot.hybrid_command()
-# async def silenthours(ctx: commands.Context):
-#     """Set the times during which you will never be notified."""
-
+@bot.hybrid_command()
+async def silenthours(ctx: commands.Context):
+    """Set the times during which you will never be notified."""
 
+    if ctx.interaction is not None:
+        await ctx.interaction.response.send_modal(SilentHoursModal(ctx.author.id))
+    else: #Modals can only be opened from an interaction
+        await ctx.send("Press continue to set your silent hours.", view=SilentHoursView(), reference=ctx.message, ephemeral=True)
 
 # endregion
 
@@ -677,119 +2651,250 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
     Event triggered when a user's voice state changes.
     Checks if a user has joined a voice channel and sends a DM to users who opted in for notifications.
     """
-    # region edit message
-    async def edit_message(channel_id: int, members_message: str, verb: str, guild_id_str: str, channel_id_str: str):
-        for user_id_str in bot.notified_channels: #If this user has been notified
-            if channel_id in bot.notified_channels[user_id_str]: #If they have been notified for this channel
-                for this_count in bot.notified_channels[user_id_str][channel_id]: #For each count they've been notified for
-                    message: discord.Message | None = bot.notified_channels[user_id_str][channel_id][this_count] #Get the previously sent notification
-                    if message is not None:
-                        await message.edit(content=f"{members_message} {verb} currently in https://discord.com/channels/{guild_id_str}/{channel_id_str}")
-    # endregion
-    # region set member message
-    def make_member_list(count: int, member_list: List[discord.Member]):
-        if count <= 5:
-            final_message = ""
-            for x in range(count):
-                if count == 1: #If there is only one user
-                    final_message += f"<@{member_list[x].id}>"
-                elif x == 0 and count == 2: #If there are two users, but we're referencing the first user
-                    final_message += f"<@{member_list[x].id}> "
-                elif x < count - 1: #If it's not the last user we're referencing
-                    final_message += f"<@{member_list[x].id}>, "
-                else: #If this is the last user we're referencing
-                    final_message += f"and <@{member_list[x].id}>"
-        else: #If there are more than five members in the channel
-            final_message = f"**{count}** members"
-        return final_message
-    # endregion
-    # region Reset pings
+    if trace_recorder is not None:
+        trace_recorder.record(member, before, after)
+    started = time.perf_counter()
+    profile = start_profile("voice_state_update")
+    try:
+        await handle_voice_state_update(member, before, after, profile)
+    finally:
+        metrics.observe("voicely_voice_state_update_seconds", time.perf_counter() - started)
+        metrics.increment("voicely_voice_state_updates_total", (("guild", member.guild.id),))
+        finish_profile(profile, f"guild {member.guild.id}, member {member.id}")
+
+async def handle_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState, profile: EventProfile | QuietProfile = QUIET_PROFILE):
+    # Bots don't count towards pings, and mute, deafen or stream changes don't change who is in a channel
+    if member.bot:
+        return
+    before_channel_id = before.channel.id if before.channel is not None else None
+    after_channel_id = after.channel.id if after.channel is not None else None
+    if before_channel_id == after_channel_id:
+        return
+    profile.phase("filter")
+    # Each channel's changes run in its own queue, so a move updates both channels at once. They each get their own
+    # profile, which is added to this one with a prefix once both are done.
+    changes: List[asyncio.Future] = []
+    parts: dict[str, EventProfile | QuietProfile] = {}
     if before.channel is not None:
-        if len(before.channel.members) == 0: #If everyone has left the voice channel
-            for user_id_str in bot.notified_channels: #For each person who has been notified
-                if before.channel.id in bot.notified_channels[user_id_str]: #If this person has been notified for this channel
-                    for this_count in bot.notified_channels[user_id_str][before.channel.id]:
-                        message: discord.Message | None = bot.notified_channels[user_id_str][before.channel.id][this_count] #Get previously sent message
-                        if message is not None: #If message exists
-                            await message.edit(content=message.content.replace("is currently", "was").replace("are currently", "were") + f".\n-# Last member left at <t:{str(datetime.datetime.now().timestamp())[:10]}:t>.")
-                    del bot.notified_channels[user_id_str][before.channel.id] #Remove channel from list, because everyone has left.
-        else: #Otherwise, just update the message for everyone who was notified
-            # region Calculate members list
-            before_member_list = before.channel.members
-            # region ignore bots
-            for before_member_check in before_member_list:
-                if before_member_check.bot:
-                    before_member_list.remove(before_member_check)
-            # endregion
-            before_count = len(before_member_list)
-            before_channel_id = before.channel.id
-            
-            if before_count == 1: #If there is one member in the channel
-                before_verb = "is"
-            else: #If there is more than one member in the channel
-                before_verb = "are"
-            # endregion
-            await edit_message(before_channel_id, make_member_list(before_count, before_member_list), before_verb, str(before.channel.guild.id), str(before_channel_id))
-
-    # endregion
-    # region Ping
+        parts["leave"] = profile.child()
+        changes.append(channel_actors.submit(before_channel_id, partial(leave_channel, member, before.channel, parts["leave"])))
     if after.channel is not None:
-        member_list = after.channel.members
-        # region ignore bots
-        for member_check in member_list:
-            if member_check.bot:
-                member_list.remove(member_check)
-        # endregion
-        count = len(member_list)
-        count_str = str(count)
-        guild_id_str = str(after.channel.guild.id)
-        channel_id = after.channel.id
-        channel_id_str = str(channel_id)
-        # region Make Message
-        members_message = make_member_list(count, member_list)
-
-        if count == 1: #If there is one member in the channel
-            verb = "is"
+        parts["join"] = profile.child()
+        changes.append(channel_actors.submit(after_channel_id, partial(join_channel, member, after.channel, parts["join"])))
+    try:
+        await asyncio.gather(*changes)
+    finally:
+        for prefix, part in parts.items():
+            profile.merge(part, prefix)
+
+# region edit message
+def edit_message(channel_id: int, members_message: str, verb: str, guild_id_str: str, channel_id_str: str):
+    content = f"{members_message} {verb} currently in https://discord.com/channels/{guild_id_str}/{channel_id_str}"
+    # Only kept in memory. It's saved along with the channel's pings when they change, and counted again in on_ready.
+    bot.channel_contents[channel_id] = content
+    for counts in bot.notified_by_channel.get(channel_id, {}).values(): #For each user who has been notified for this channel
+        for record in counts.values(): #For each count they've been notified for
+            if record is not None:
+                edit_coalescer.queue(channel_id, record, content)
+# endregion
+# region set member message
+def make_member_list(count: int, member_ids: dict[int, None]):
+    if count <= 5:
+        final_message = ""
+        for x, member_id in enumerate(member_ids):
+            if count == 1: #If there is only one user
+                final_message += f"<@{member_id}>"
+            elif x == 0 and count == 2: #If there are two users, but we're referencing the first user
+                final_message += f"<@{member_id}> "
+            elif x < count - 1: #If it's not the last user we're referencing
+                final_message += f"<@{member_id}>, "
+            else: #If this is the last user we're referencing
+                final_message += f"and <@{member_id}>"
+    else: #If there are more than five members in the channel
+        final_message = f"**{count}** members"
+    return final_message
+# endregion
+
+# region Reset pings
+async def leave_channel(member: discord.Member, channel: discord.VoiceChannel, profile: EventProfile | QuietProfile):
+    profile.phase("queued")
+    before_channel_id = channel.id
+    before_members = bot.voice_members.get(before_channel_id, {})
+    before_members.pop(member.id, None)
+    if len(before_members) == 0: #If everyone has left the voice channel
+        bot.voice_members.pop(before_channel_id, None)
+        reset_channel_notifications(before_channel_id)
+    else: #Otherwise, just update the message for everyone who was notified
+        before_count = len(before_members)
+
+        if before_count == 1: #If there is one member in the channel
+            before_verb = "is"
         else: #If there is more than one member in the channel
-            verb = "are"
-        # endregion
-        if guild_id_str in pings and channel_id_str in pings[guild_id_str] and count_str in pings[guild_id_str][channel_id_str]: #If people have signed up to be pinged for this count in this channel and guild
-            for pinged_id_str in pings[guild_id_str][channel_id_str][count_str]: #For each user that wants to be pinged for this count
-                pinged_user = bot.get_user(int(pinged_id_str))
-                if pinged_id_str in bot.notified_channels: #If this user already has been pinged, and that has already been recorded
-                    if channel_id in bot.notified_channels[pinged_id_str]: #if they were already pinged for this channel
-                        if count in bot.notified_channels[pinged_id_str][channel_id]: #if they were already pinged for this count
-                            await edit_message(channel_id, members_message, verb, guild_id_str, channel_id_str)
-                            continue
-                        elif pinged_user not in member_list: #If they were not yet pinged for this count, and they're also not in the channel
-                            for this_count in bot.notified_channels[pinged_id_str][channel_id]:
-                                to_delete: discord.Message | None = bot.notified_channels[pinged_id_str][channel_id][this_count]
-                                if to_delete is not None:
-                                    await to_delete.delete() #Delete the message, then continue to send the next one after this if statement
-                                    bot.notified_channels[pinged_id_str][channel_id][this_count] = None
-                        else: #If they were not pinged for this count, but they're in the voice channel
-                            await edit_message(channel_id, members_message, verb, guild_id_str, channel_id_str)
-                else: #If it's not recorded that this user has been pinged
-                    bot.notified_channels[pinged_id_str] = {} #Add a dictionary for this user containing channel id's
-
-                if channel_id not in bot.notified_channels[pinged_id_str]:
-                    bot.notified_channels[pinged_id_str][channel_id] = {}
-                    
-                if pinged_user in member_list: #If this user is in the voice channel
+            before_verb = "are"
+        edit_message(before_channel_id, make_member_list(before_count, before_members), before_verb, str(channel.guild.id), str(before_channel_id))
+    profile.phase("edits")
+
+# endregion
+
+# region Recount
+async def recount_channels(counted: dict[int, tuple[int | None, dict[int, None]]]):
+    """Recount each channel in its actor, so it can't interleave with a voice event. Empty channels the bot knows nothing about are skipped."""
+    await asyncio.gather(*(
+        channel_actors.submit(channel_id, partial(recount_channel, channel_id, guild_id, member_ids))
+        for channel_id, (guild_id, member_ids) in counted.items()
+        if len(member_ids) > 0 or channel_id in bot.voice_members or channel_id in bot.notified_by_channel
+    ))
+
+async def recount_channel(channel_id: int, guild_id: int | None, member_ids: dict[int, None]):
+    """
+    Bring a channel up to date with a fresh count of who is in it, after voice state updates may have been missed.
+    Its pings are finished if it emptied. If the people in it changed, its roster is edited and the counts it passed
+    are pinged for.
+    """
+    previous_members = bot.voice_members.get(channel_id, {})
+    if len(member_ids) == 0:
+        bot.voice_members.pop(channel_id, None)
+        if channel_id in bot.notified_by_channel:
+            reset_channel_notifications(channel_id)
+        return
+    bot.voice_members[channel_id] = member_ids
+    count = len(member_ids)
+    if count == 1: #If there is one member in the channel
+        verb = "is"
+    else: #If there is more than one member in the channel
+        verb = "are"
+    # Anyone whose count was passed while the bot was disconnected is pinged now
+    previous_count = len(previous_members) if bot.voice_counted else count
+    # Roster changes aren't saved, so after a restart this compares with the content saved with the channel's pings
+    content = f"{make_member_list(count, member_ids)} {verb} currently in https://discord.com/channels/{guild_id}/{channel_id}"
+    if previous_count >= count and content == bot.channel_contents.get(channel_id):
+        return
+    await ping_channel(channel_id, guild_id, previous_count)
+# endregion
+
+# region Ping
+async def join_channel(member: discord.Member, channel: discord.VoiceChannel, profile: EventProfile | QuietProfile):
+    profile.phase("queued")
+    after_members = bot.voice_members.setdefault(channel.id, {})
+    previous_count = len(after_members)
+    after_members[member.id] = None
+    await ping_channel(channel.id, channel.guild.id, previous_count, profile)
+
+async def ping_channel(channel_id: int, guild_id: int, previous_count: int, profile: EventProfile | QuietProfile = QUIET_PROFILE):
+    """Ping the subscribers for every count this channel passed since it had `previous_count` people, and edit its roster for everyone else."""
+    after_members = bot.voice_members[channel_id]
+    count = len(after_members)
+    guild_id_str = str(guild_id)
+    channel_id_str = str(channel_id)
+    # region Make Message
+    members_message = make_member_list(count, after_members)
+
+    if count == 1: #If there is one member in the channel
+        verb = "is"
+    else: #If there is more than one member in the channel
+        verb = "are"
+    # endregion
+    profile.phase("filter")
+    # Every count with pings that was passed since the last event, so none are missed if several people arrived at once
+    # while the bot was offline
+    thresholds = crossed_thresholds(channel_id, previous_count, count)
+    if len(thresholds) > 0 and len(SHARD_IDS) > 0:
+        await forget_removed_pings(channel_id, thresholds)
+        thresholds = crossed_thresholds(channel_id, previous_count, count)
+    if len(thresholds) > 0: #If people have signed up to be pinged for one of these counts in this channel
+        content = f"{members_message} {verb} currently in https://discord.com/channels/{guild_id_str}/{channel_id_str}"
+
+        def still_wanted(pinged_id: int, notified_counts: dict, threshold: int):
+            # The channel may have emptied, or the user been pinged for a higher count, while the ping was queued
+            return bot.get_notifications(pinged_id, channel_id) is notified_counts and notified_counts.get(threshold, False) is None and max(notified_counts) == threshold
+
+        async def deliver_ping(pinged_id: int, notified_counts: dict, threshold: int):
+            if not still_wanted(pinged_id, notified_counts, threshold):
+                return
+            sent = bot.channel_contents.get(channel_id, content) #The roster may have changed since the ping was queued
+            message = await bot.send_dm(pinged_id, sent)
+            record = NotificationRecord(message.channel.id, message.id)
+            if not still_wanted(pinged_id, notified_counts, threshold): #Changed during the send
+                outbound.delete(record)
+                return
+            notified_counts[threshold] = record
+            cooldowns.record_sent(channel_id, pinged_id)
+            storage.notifications_changed(channel_id)
+            latest = bot.channel_contents.get(channel_id, sent)
+            if latest != sent:
+                edit_coalescer.queue(channel_id, record, latest)
+
+        def report_failed_ping(pinged_id: int, future: asyncio.Future):
+            if not future.cancelled() and future.exception() is not None:
+                print(f"Could not send ping to {pinged_id}: {future.exception()}")
+
+        subscribers = pings[channel_id].subscribers
+        handled: set[int] = set()
+        for threshold in reversed(thresholds): #Highest count first, so each user is only pinged for the highest count they passed
+            for pinged_id in subscribers[threshold]: #For each user that wants to be pinged for this count
+                if pinged_id in handled:
                     continue
-                bot.notified_channels[pinged_id_str][channel_id][count] = None
-                
-                try:
-                    message = await pinged_user.send(f"{members_message} {verb} currently in https://discord.com/channels/{guild_id_str}/{channel_id_str}")
-                except discord.Forbidden as error:
-                    print(f"Could not send ping to {pinged_user.name}: {error}")
-                
+                handled.add(pinged_id)
+                if pinged_id in silent_hours.muted: #Sent once their silent hours end, if the channel is still busy
+                    silent_hours.hold(pinged_id, channel_id, threshold)
+                    continue
+
+                in_channel = pinged_id in after_members
+                to_delete: List[NotificationRecord] = []
+                notified_counts = bot.get_notifications(pinged_id, channel_id)
+                if notified_counts is not None and threshold in notified_counts: #if they were already pinged for this count, their message is edited below
+                    continue
+                if not in_channel and cooldowns.cooldown > 0:
+                    # Pinged for this channel moments ago, so move their message to this count instead of replacing it
+                    record = cooldowns.reuse(channel_id, pinged_id, notified_counts)
+                    if record is not None:
+                        notified_counts = bot.ensure_notifications(pinged_id, channel_id, guild_id)
+                        for this_count in notified_counts:
+                            if notified_counts[this_count] is record:
+                                notified_counts[this_count] = None
+                        notified_counts[threshold] = record
+                        storage.notifications_changed(channel_id)
+                        continue
+                if notified_counts is not None: #if they were already pinged for this channel
+                    if not in_channel: #If they were not yet pinged for this count, and they're also not in the channel
+                        for this_count in notified_counts:
+                            record = notified_counts[this_count]
+                            if record is not None:
+                                edit_coalescer.discard(channel_id, record.message_id)
+                                if record.release(channel_id): #Delete the message before sending the next one
+                                    if record not in to_delete:
+                                        to_delete.append(record)
+                                else: #A digest that is still about other channels just loses this one
+                                    other_channel_id, other_content = next(iter(record.sections.items()))
+                                    edit_coalescer.queue(other_channel_id, record, other_content)
+                                    storage.notifications_changed(other_channel_id)
+                                notified_counts[this_count] = None
+
+                notified_counts = bot.ensure_notifications(pinged_id, channel_id, guild_id)
+
+                if in_channel: #If this user is in the voice channel
+                    continue
+                notified_counts[threshold] = None
+                if pinged_id in digest_users: #Sent with their other pings once the digest window has passed
+                    digests.add(pinged_id, DigestEntry(channel_id, notified_counts, threshold, to_delete))
                 else:
-                    bot.notified_channels[pinged_id_str][channel_id][count] = message
-        else:
-            await edit_message(channel_id, members_message, verb, guild_id_str, channel_id_str)
-            
-    # endregion
+                    # The old notifications are deleted before the new one is sent, so each user only sees one at a time
+                    deleted = [outbound.delete(record) for record in to_delete]
+                    outbound.send(pinged_id, partial(deliver_ping, pinged_id, notified_counts, threshold), after=deleted).add_done_callback(partial(report_failed_ping, pinged_id))
+        if len(handled) > 0:
+            storage.notifications_changed(channel_id)
+        profile.phase("lookup")
+
+        # Everyone else who was notified for this channel gets the new roster. This is queued before the new pings
+        # are sent, so brand new messages aren't edited straight away.
+        edit_message(channel_id, members_message, verb, guild_id_str, channel_id_str)
+        profile.phase("edits")
+    else:
+        profile.phase("lookup")
+        edit_message(channel_id, members_message, verb, guild_id_str, channel_id_str)
+        profile.phase("edits")
+        
+# endregion
 
 
 @bot.command()
@@ -824,5 +2929,10 @@ async def sync(ctx: commands.Context, guild: discord.Guild = None):
         await ctx.send(f"Commands synced globally:{command_list}\nPlease note it may take up to an hour to propagate globally.", reference=ctx.message, ephemeral=True)
 
 
-# Run the bot with the loaded token
-bot.run(bot_token)
+if __name__ == "__main__":
+    # Load bot token from file
+    with open('../token', 'r') as file:
+        bot_token = file.read().strip()
+
+    # Run the bot with the loaded token
+    bot.run(bot_token)